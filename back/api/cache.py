@@ -1,28 +1,349 @@
+import asyncio
+import hashlib
 import json
-from typing import Any
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
 
+from aioredis.exceptions import LockError, RedisError
+from config import (
+    CACHE_LOCAL_ENABLED,
+    CACHE_LOCAL_MAX_BYTES,
+    CACHE_LOCAL_MAX_ENTRIES,
+    CACHE_LOCK_TIMEOUT,
+    CACHE_STALE_TTL,
+    CACHE_TTL_DISH,
+    CACHE_TTL_MENU,
+    CACHE_TTL_SUBMENU,
+)
 from db.redis import redis_client
-from fastapi.encoders import jsonable_encoder
+
+logger = logging.getLogger(__name__)
+
+TAG_PREFIX = "tag:"
+MENUS_TAG = f"{TAG_PREFIX}menus"
+LOCK_PREFIX = "lock:"
+INVALIDATION_CHANNEL = "cache_invalidation"
+# Bumped by every invalidation, i.e. by every committed write
+DATA_VERSION_KEY = "data_version"
+# Snapshot of the whole tree, dropped by every invalidation
+MENUS_FULL_KEY = "menus_full"
+
+# Fresh lifetime of a key by the family prefix of its name
+CACHE_TTL = {
+    "menus": CACHE_TTL_MENU,
+    "menu": CACHE_TTL_MENU,
+    "submenu": CACHE_TTL_SUBMENU,
+    "dish": CACHE_TTL_DISH,
+}
+TAG_TTL = max(CACHE_TTL.values()) + CACHE_STALE_TTL
+WAIT_INTERVAL = 0.05
+
+# Drops every key registered under the tag sets in KEYS, the tag sets
+# themselves and the plain keys in ARGV in a single atomic round trip,
+# then broadcasts the dropped keys to the local caches of all workers.
+DELETE_TAGGED_SCRIPT = f"""
+redis.call('INCR', '{DATA_VERSION_KEY}')
+local dropped = {{}}
+for _, tag in ipairs(KEYS) do
+    for _, key in ipairs(redis.call('SMEMBERS', tag)) do
+        table.insert(dropped, key)
+    end
+    table.insert(dropped, tag)
+end
+for _, key in ipairs(ARGV) do
+    table.insert(dropped, key)
+end
+for _, key in ipairs(dropped) do
+    redis.call('DEL', key)
+end
+if #dropped > 0 then
+    redis.call('PUBLISH', '{INVALIDATION_CHANNEL}', cjson.encode(dropped))
+end
+return dropped
+"""
+
+# A loader returns the encoded body, optionally with response headers
+Loader = Callable[[], Awaitable[bytes | tuple[bytes, dict[str, str]] | None]]
+
+
+def menu_tag(menu_id: int) -> str:
+    """Tag of every cached entry that belongs to the menu"""
+    return f"{TAG_PREFIX}menu_{menu_id}"
+
+
+def submenu_tag(menu_id: int, submenu_id: int) -> str:
+    """Tag of every cached entry that belongs to the submenu"""
+    return f"{TAG_PREFIX}submenu_{menu_id}_{submenu_id}"
+
+
+def submenus_tag(menu_id: int) -> str:
+    """Tag of the submenu list pages of the menu"""
+    return f"{TAG_PREFIX}submenus_{menu_id}"
+
+
+def dishes_tag(menu_id: int, submenu_id: int) -> str:
+    """Tag of the dish list pages of the submenu"""
+    return f"{TAG_PREFIX}dishes_{menu_id}_{submenu_id}"
+
+
+@dataclass
+class Invalidation:
+    """Tags and keys a write makes stale, merged over the writes of one transaction"""
+
+    tags: set[str] = field(default_factory=set)
+    keys: set[str] = field(default_factory=set)
+
+    def __or__(self, other: "Invalidation") -> "Invalidation":
+        return Invalidation(self.tags | other.tags, self.keys | other.keys)
+
+
+def ttl_for(key: str) -> int:
+    return CACHE_TTL.get(key.split("_", 1)[0], CACHE_TTL_MENU)
+
+
+@dataclass
+class CacheEntry:
+    body: bytes
+    etag: str
+    soft_expires_at: float
+    expires_at: float
+    headers: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def stale(self) -> bool:
+        return time.time() >= self.soft_expires_at
+
+    @property
+    def expired(self) -> bool:
+        return time.time() >= self.expires_at
+
+    def dumps(self) -> bytes:
+        header = json.dumps(
+            {
+                "etag": self.etag,
+                "soft_expires_at": self.soft_expires_at,
+                "expires_at": self.expires_at,
+                "headers": self.headers,
+            }
+        )
+        return header.encode() + b"\n" + self.body
+
+    @classmethod
+    def loads(cls, data: bytes) -> "CacheEntry":
+        header, body = data.split(b"\n", 1)
+        return cls(body=body, **json.loads(header))
+
+
+class LocalCache:
+    """In-process LRU bounded by entry count and payload bytes"""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[str, tuple[CacheEntry, int]] = OrderedDict()
+
+    def get(self, key: str) -> CacheEntry | None:
+        item = self.entries.get(key)
+        if item is None:
+            return None
+        if item[0].expired:
+            self.delete([key])
+            return None
+        self.entries.move_to_end(key)
+        return item[0]
+
+    def set(self, key: str, entry: CacheEntry, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        self.delete([key])
+        self.entries[key] = (entry, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def delete(self, keys: list[str]) -> None:
+        for key in keys:
+            item = self.entries.pop(key, None)
+            if item is not None:
+                self.size -= item[1]
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
 
 
 class RedisCache:
-    async def get(self, key: str) -> Any | None:
+    def __init__(self, local: LocalCache | None = None):
+        self.local = local
+        self.listener: asyncio.Task | None = None
+        self.refreshing: set[asyncio.Task] = set()
+        self.delete_tagged = redis_client.register_script(DELETE_TAGGED_SCRIPT)
+
+    async def get_entry(self, key: str) -> CacheEntry | None:
+        if self.local:
+            entry = self.local.get(key)
+            # a stale local copy may already be refreshed by another worker
+            if entry is not None and not entry.stale:
+                return entry
+
         data = await redis_client.get(name=key)
         if not data:
             return None
-        return json.loads(data)
+        entry = CacheEntry.loads(data)
+        if self.local:
+            self.local.set(key, entry, len(data))
+        return entry
+
+    async def set(
+        self,
+        key: str,
+        body: bytes,
+        tags: list[str] | None = None,
+        headers: dict[str, str] | None = None,
+    ) -> CacheEntry:
+        ttl = ttl_for(key)
+        now = time.time()
+        entry = CacheEntry(
+            body=body,
+            etag=f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"',
+            soft_expires_at=now + ttl,
+            expires_at=now + ttl + CACHE_STALE_TTL,
+            headers=headers or {},
+        )
+        data = entry.dumps()
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.set(name=key, value=data, ex=ttl + CACHE_STALE_TTL)
+            for tag in tags or []:
+                pipe.sadd(tag, key)
+                pipe.expire(tag, TAG_TTL)
+            await pipe.execute()
+        if self.local:
+            self.local.set(key, entry, len(data))
+        return entry
+
+    async def get_or_set(
+        self,
+        key: str,
+        loader: Loader,
+        tags: list[str] | None = None,
+    ) -> CacheEntry | None:
+        """Cached response of key, computed by loader by one caller at a time.
+
+        A stale body is returned as is while one worker recomputes it in
+        the background; on a miss the other callers wait for the worker
+        holding the lock instead of running the same query.
+        """
+        entry = await self.get_entry(key)
+        if entry is not None:
+            if entry.stale:
+                await self.refresh(key, loader, tags)
+            return entry
+
+        lock = self.lock(key)
+        if await lock.acquire(blocking=False):
+            try:
+                return await self.load(key, loader, tags)
+            finally:
+                await self.release(lock)
+
+        entry = await self.wait_for(key)
+        if entry is not None:
+            return entry
+        return await self.load(key, loader, tags)
+
+    async def load(self, key: str, loader: Loader, tags: list[str] | None) -> CacheEntry | None:
+        result = await loader()
+        if result is None:
+            return None
+        body, headers = result if isinstance(result, tuple) else (result, {})
+        return await self.set(key, body, tags, headers)
+
+    async def refresh(self, key: str, loader: Loader, tags: list[str] | None) -> None:
+        lock = self.lock(key)
+        if not await lock.acquire(blocking=False):
+            return
+
+        async def run():
+            try:
+                await self.load(key, loader, tags)
+            except Exception:
+                logger.exception("Background refresh of %s failed", key)
+            finally:
+                await self.release(lock)
+
+        task = asyncio.create_task(run())
+        self.refreshing.add(task)
+        task.add_done_callback(self.refreshing.discard)
+
+    async def wait_for(self, key: str) -> CacheEntry | None:
+        """Wait until the lock holder stores key or gives up the lock"""
+        deadline = time.monotonic() + CACHE_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(WAIT_INTERVAL)
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.get(name=key)
+                pipe.exists(f"{LOCK_PREFIX}{key}")
+                data, locked = await pipe.execute()
+            if data:
+                return CacheEntry.loads(data)
+            if not locked:
+                break
+        return None
+
+    def lock(self, key: str):
+        return redis_client.lock(f"{LOCK_PREFIX}{key}", timeout=CACHE_LOCK_TIMEOUT, thread_local=False)
+
+    async def release(self, lock) -> None:
+        try:
+            await lock.release()
+        except LockError:
+            pass
+
+    async def delete_all(self, tags: list[str], keys: list[str] | None = None) -> None:
+        """Drop the keys registered under tags together with the given keys"""
+        dropped = await self.delete_tagged(keys=tags, args=[*(keys or []), MENUS_FULL_KEY])
+        if self.local:
+            self.local.delete([key.decode() for key in dropped])
+
+    async def invalidate(self, invalidation: Invalidation) -> None:
+        if not invalidation.tags and not invalidation.keys:
+            return
+        await self.delete_all(sorted(invalidation.tags), keys=sorted(invalidation.keys))
+
+    async def data_version(self) -> int:
+        """Counter of writes, equal for reads of the same menu data"""
+        return int(await redis_client.get(DATA_VERSION_KEY) or 0)
 
-    async def set(self, key: str, value: Any) -> None:
-        data = json.dumps(jsonable_encoder(value))
-        await redis_client.set(name=key, value=data)
+    def start_listener(self) -> None:
+        if self.local and self.listener is None:
+            self.listener = asyncio.create_task(self.listen_invalidations())
 
-    async def delete_one(self, keys: list[str] | str) -> None:
-        await redis_client.delete(*keys)
+    async def stop_listener(self) -> None:
+        if self.listener is not None:
+            self.listener.cancel()
+            self.listener = None
 
-    async def delete_all(self, key: list[str]) -> None:
-        keys = await redis_client.keys(f"{key}*")
-        if keys:
-            await redis_client.delete(*keys)
+    async def listen_invalidations(self) -> None:
+        """Drop local copies of keys invalidated by any worker"""
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                # messages may have been missed while unsubscribed
+                self.local.clear()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.local.delete(json.loads(message["data"]))
+            except (RedisError, OSError):
+                self.local.clear()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
 
 
-cache = RedisCache()
+cache = RedisCache(LocalCache(CACHE_LOCAL_MAX_ENTRIES, CACHE_LOCAL_MAX_BYTES) if CACHE_LOCAL_ENABLED else None)
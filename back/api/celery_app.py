@@ -1,12 +1,15 @@
 from celery import Celery
-from config import RABBITMQ_HOST, RABBITMQ_PASS, RABBITMQ_PORT, RABBITMQ_USER
+from config import EXPORT_TTL, RABBITMQ_HOST, RABBITMQ_PASS, RABBITMQ_PORT, RABBITMQ_USER, REDIS_DB, REDIS_HOST
 
 celery_app = Celery(
     "create_file_xlsx",
     broker=f"amqp://{RABBITMQ_USER}:{RABBITMQ_PASS}@{RABBITMQ_HOST}:{RABBITMQ_PORT}//",
-    backend="rpc://",
+    backend=f"redis://{REDIS_HOST}/{REDIS_DB}",
     include=["api.tasks"],
 )
+celery_app.conf.result_expires = EXPORT_TTL
+# PENDING then only means the task still waits in the queue
+celery_app.conf.task_track_started = True
 
 if __name__ == "__main__":
     celery_app.start()
@@ -0,0 +1,180 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from multiprocessing.managers import DictProxy, SyncManager
+from typing import Any, Protocol
+
+from celery import states
+from config import EXPORT_BACKEND, EXPORT_LOCAL_WORKERS, EXPORT_QUEUE_TIMEOUT, EXPORT_STALL_TIMEOUT, EXPORT_TTL
+from db.redis import redis_client
+from starlette.concurrency import run_in_threadpool
+
+from .tasks import PROGRESS, beat_key, export_menu, get_result, run_local_export
+
+# State of a task the backend has no record of, e.g. after a restart
+LOST = "LOST"
+WAIT_INTERVAL = 0.5
+
+
+class ExportBackend(Protocol):
+    def submit(self, task_id: str, version: int, file_format: str) -> None:
+        ...
+
+    async def status(self, task_id: str) -> tuple[str, Any]:
+        ...
+
+    async def wait(self, task_id: str, timeout: int) -> None:
+        ...
+
+    async def stalled(self, task_id: str, state: str) -> bool:
+        """The task is not ready yet but will never get there"""
+        ...
+
+    def shutdown(self) -> None:
+        ...
+
+
+class CeleryBackend:
+    """Exports run by Celery workers, states kept in the Redis result backend"""
+
+    def submit(self, task_id: str, version: int, file_format: str) -> None:
+        export_menu.apply_async(args=[version, file_format], task_id=task_id)
+
+    async def status(self, task_id: str) -> tuple[str, Any]:
+        task = get_result(task_id)
+        return await run_in_threadpool(lambda: (task.state, task.info))
+
+    async def wait(self, task_id: str, timeout: int) -> None:
+        """Block until the worker stores a new state of the task or timeout passes"""
+        task = get_result(task_id)
+        pubsub = redis_client.pubsub()
+        try:
+            # the result backend publishes every state on the key it is stored under
+            await pubsub.subscribe(task.backend.get_key_for_task(task.id))
+            if await run_in_threadpool(task.ready):
+                return
+            await asyncio.wait_for(self.next_message(pubsub), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await pubsub.reset()
+
+    async def stalled(self, task_id: str, state: str) -> bool:
+        """No heartbeat from the task for too long, e.g. after its worker died.
+
+        A task still in the queue only gets its first heartbeat once a worker
+        takes it, so it is given EXPORT_QUEUE_TIMEOUT rather than EXPORT_STALL_TIMEOUT.
+        """
+        timeout = EXPORT_QUEUE_TIMEOUT if state == states.PENDING else EXPORT_STALL_TIMEOUT
+        last_beat = await redis_client.get(beat_key(task_id))
+        return last_beat is None or time.time() - int(last_beat) > timeout
+
+    @staticmethod
+    async def next_message(pubsub) -> None:
+        async for message in pubsub.listen():
+            if message["type"] == "message":
+                return
+
+    def shutdown(self) -> None:
+        pass
+
+
+@dataclass
+class LocalJob:
+    future: Future
+    submitted_at: float = field(default_factory=time.time)
+
+
+@dataclass
+class LocalPool:
+    executor: ProcessPoolExecutor
+    manager: SyncManager
+    # progress reported by the workers, by task id
+    progress: DictProxy
+
+    @classmethod
+    def start(cls, max_workers: int) -> "LocalPool":
+        context = multiprocessing.get_context("spawn")
+        manager = context.Manager()
+        return cls(ProcessPoolExecutor(max_workers=max_workers, mp_context=context), manager, manager.dict())
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.manager.shutdown()
+
+
+class LocalBackend:
+    """Exports run in a process pool of the API process itself.
+
+    The registry lives in this process only, so ids handed out by another
+    API process or before a restart are reported as lost.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.local_pool: LocalPool | None = None
+        self.jobs: dict[str, LocalJob] = {}
+
+    @property
+    def pool(self) -> LocalPool:
+        if self.local_pool is None:
+            self.local_pool = LocalPool.start(self.max_workers)
+        return self.local_pool
+
+    def submit(self, task_id: str, version: int, file_format: str) -> None:
+        self.prune()
+        try:
+            future = self.pool.executor.submit(run_local_export, task_id, version, file_format, self.pool.progress)
+        except BrokenProcessPool:
+            # a worker died, e.g. killed for memory, and the pool refuses any further work;
+            # the jobs it was running have already failed with the same error
+            self.shutdown()
+            future = self.pool.executor.submit(run_local_export, task_id, version, file_format, self.pool.progress)
+        self.jobs[task_id] = LocalJob(future)
+
+    def prune(self) -> None:
+        """Forget finished jobs whose results have expired"""
+        expired = time.time() - EXPORT_TTL
+        for task_id, job in list(self.jobs.items()):
+            if job.future.done() and job.submitted_at < expired:
+                del self.jobs[task_id]
+                self.pool.progress.pop(task_id, None)
+
+    async def status(self, task_id: str) -> tuple[str, Any]:
+        job = self.jobs.get(task_id)
+        if job is None:
+            return LOST, None
+        if not job.future.done():
+            meta = await run_in_threadpool(self.pool.progress.get, task_id)
+            return (PROGRESS, meta) if meta else (states.PENDING, None)
+        if job.future.exception() is not None:
+            return states.FAILURE, repr(job.future.exception())
+        return states.SUCCESS, job.future.result()
+
+    async def wait(self, task_id: str, timeout: int) -> None:
+        """Block until the job reports progress, finishes or timeout passes"""
+        job = self.jobs.get(task_id)
+        if job is None:
+            return
+        initial = await self.status(task_id)
+        done = asyncio.wrap_future(job.future)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await asyncio.wait({done}, timeout=min(WAIT_INTERVAL, deadline - time.monotonic()))
+            if done.done() or await self.status(task_id) != initial:
+                return
+
+    async def stalled(self, task_id: str, state: str) -> bool:
+        # a dead pool child fails the futures of the pool, so a job never hangs unnoticed
+        return False
+
+    def shutdown(self) -> None:
+        if self.local_pool is not None:
+            self.local_pool.shutdown()
+            self.local_pool = None
+
+
+export_backend: ExportBackend = LocalBackend(EXPORT_LOCAL_WORKERS) if EXPORT_BACKEND == "local" else CeleryBackend()
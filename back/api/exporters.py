@@ -0,0 +1,178 @@
+import csv
+import shutil
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass, replace
+from enum import Enum
+from itertools import islice
+from typing import Any
+
+import openpyxl
+import orjson
+from config import EXPORT_CHUNK_SIZE
+from sqlalchemy.engine import Row
+
+# Columns of ServiceQuery.select_menu_tree, one row per dish
+TREE_FIELDS = (
+    "menu_id",
+    "menu_title",
+    "menu_description",
+    "submenu_id",
+    "submenu_title",
+    "submenu_description",
+    "dish_id",
+    "dish_title",
+    "dish_description",
+    "dish_price",
+)
+
+
+class ExportFormat(str, Enum):
+    xlsx = "xlsx"
+    csv = "csv"
+    ndjson = "ndjson"
+    parquet = "parquet"
+
+
+Writer = Callable[[Iterable[Row], str], None]
+# Joins the files written for consecutive shards of the tree into one
+Merger = Callable[[list[str], str], None]
+
+
+@dataclass(frozen=True)
+class Exporter:
+    media_type: str
+    write: Writer
+    # worth a gzip copy, unlike the formats compressed on their own
+    compressible: bool = False
+    merge: Merger | None = None
+
+
+EXPORTERS: dict[ExportFormat, Exporter] = {}
+
+
+def exporter(file_format: ExportFormat, media_type: str, compressible: bool = False) -> Callable[[Writer], Writer]:
+    """Register a writer of the tree rows into a file of the format"""
+
+    def register(write: Writer) -> Writer:
+        EXPORTERS[file_format] = Exporter(media_type, write, compressible)
+        return write
+
+    return register
+
+
+def merger(file_format: ExportFormat) -> Callable[[Merger], Merger]:
+    """Register how shards written by the exporter of the format are merged"""
+
+    def register(merge: Merger) -> Merger:
+        EXPORTERS[file_format] = replace(EXPORTERS[file_format], merge=merge)
+        return merge
+
+    return register
+
+
+def concatenate(parts: list[str], file_name: str, skip_lines: int = 0) -> None:
+    """Copy the parts one after another, skipping the header lines of all but the first"""
+    with open(file_name, "wb") as target:
+        for index, part in enumerate(parts):
+            with open(part, "rb") as source:
+                for _ in range(skip_lines if index else 0):
+                    source.readline()
+                shutil.copyfileobj(source, target, 1024 * 1024)
+
+
+def chunks(records: Iterable[Row], size: int = EXPORT_CHUNK_SIZE) -> Iterator[list[Row]]:
+    records = iter(records)
+    while chunk := list(islice(records, size)):
+        yield chunk
+
+
+def menu_rows(records: Iterable[Row]) -> Iterator[list[Any]]:
+    """Sheet rows of the menu tree, each level indented by one column"""
+    menu_id = submenu_id = None
+    menu_counter = submenu_counter = dish_counter = 0
+    for record in records:
+        if record.menu_id != menu_id:
+            menu_id, submenu_id = record.menu_id, None
+            menu_counter, submenu_counter = menu_counter + 1, 0
+            yield [menu_counter, record.menu_title, record.menu_description]
+        if record.submenu_id is not None and record.submenu_id != submenu_id:
+            submenu_id = record.submenu_id
+            submenu_counter, dish_counter = submenu_counter + 1, 0
+            yield [None, submenu_counter, record.submenu_title, record.submenu_description]
+        if record.dish_id is not None:
+            dish_counter += 1
+            yield [None, None, dish_counter, record.dish_title, record.dish_description, record.dish_price]
+
+
+# no merger: reparsing the shards costs more than writing the sheet in one go,
+# so xlsx exports are never sharded
+@exporter(ExportFormat.xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+def save_to_xlsx(records: Iterable[Row], file_name: str) -> None:
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet()
+    for row in menu_rows(records):
+        sheet.append(row)
+    book.save(file_name)
+    book.close()
+
+
+@exporter(ExportFormat.csv, "text/csv", compressible=True)
+def save_to_csv(records: Iterable[Row], file_name: str) -> None:
+    with open(file_name, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(TREE_FIELDS)
+        for chunk in chunks(records):
+            writer.writerows(chunk)
+
+
+@merger(ExportFormat.csv)
+def merge_csv(parts: list[str], file_name: str) -> None:
+    concatenate(parts, file_name, skip_lines=1)
+
+
+@exporter(ExportFormat.ndjson, "application/x-ndjson", compressible=True)
+def save_to_ndjson(records: Iterable[Row], file_name: str) -> None:
+    with open(file_name, "wb") as file:
+        for chunk in chunks(records):
+            file.writelines(orjson.dumps(record._asdict(), default=str) + b"\n" for record in chunk)
+
+
+@merger(ExportFormat.ndjson)
+def merge_ndjson(parts: list[str], file_name: str) -> None:
+    concatenate(parts, file_name)
+
+
+@exporter(ExportFormat.parquet, "application/vnd.apache.parquet")
+def save_to_parquet(records: Iterable[Row], file_name: str) -> None:
+    # pyarrow is heavy and only needed by the worker writing parquet
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema(
+        [
+            ("menu_id", pa.int64()),
+            ("menu_title", pa.string()),
+            ("menu_description", pa.string()),
+            ("submenu_id", pa.int64()),
+            ("submenu_title", pa.string()),
+            ("submenu_description", pa.string()),
+            ("dish_id", pa.int64()),
+            ("dish_title", pa.string()),
+            ("dish_description", pa.string()),
+            ("dish_price", pa.decimal128(10, 2)),
+        ]
+    )
+    with pq.ParquetWriter(file_name, schema) as writer:
+        for chunk in chunks(records):
+            writer.write_table(pa.Table.from_pylist([record._asdict() for record in chunk], schema=schema))
+
+
+@merger(ExportFormat.parquet)
+def merge_parquet(parts: list[str], file_name: str) -> None:
+    import pyarrow.parquet as pq
+
+    with pq.ParquetWriter(file_name, pq.read_schema(parts[0])) as writer:
+        for part in parts:
+            shard = pq.ParquetFile(part)
+            for index in range(shard.num_row_groups):
+                writer.write_table(shard.read_row_group(index))
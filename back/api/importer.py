@@ -0,0 +1,101 @@
+from collections.abc import AsyncIterator, Iterator
+from decimal import Decimal, InvalidOperation
+from typing import IO, Any
+from zipfile import BadZipFile
+
+import ijson
+import openpyxl
+from asyncpg.exceptions import DataError as CopyDataError
+from config import IMPORT_CHUNK_SIZE
+from db.staging import import_dish, import_menu, import_submenu
+from openpyxl.utils.exceptions import InvalidFileException
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import iterate_in_threadpool
+
+from .exporters import chunks
+
+# A staged row: the staging table it goes to and its values in column order
+Staged = tuple[str, tuple[Any, ...]]
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Bytes read ahead to check the JSON document is an array
+JSON_PEEK_SIZE = 1024
+
+# Raised for files that do not hold a menu tree, or hold values the columns refuse
+IMPORT_ERRORS = (
+    KeyError,
+    TypeError,
+    InvalidOperation,
+    ijson.JSONError,
+    BadZipFile,
+    InvalidFileException,
+    CopyDataError,
+    IntegrityError,
+)
+
+
+def price(value: Any) -> Decimal:
+    return Decimal(str(value))
+
+
+async def json_rows(file) -> AsyncIterator[Staged]:
+    """Staged rows of a tree shaped like generate_data.json, parsed one menu at a time"""
+    # any other document has no "item" prefix and would pass as an empty tree
+    if not (await file.read(JSON_PEEK_SIZE)).lstrip().startswith(b"["):
+        raise ijson.JSONError("a JSON array of menus is expected")
+    await file.seek(0)
+
+    async for menu in ijson.items(file, "item"):
+        yield import_menu.name, (menu["title"], menu.get("description"))
+        for submenu in menu.get("submenus") or []:
+            yield import_submenu.name, (submenu["title"], submenu.get("description"), menu["title"])
+            for dish in submenu.get("dishes") or []:
+                row = (dish["title"], dish.get("description"), price(dish["price"]), submenu["title"])
+                yield import_dish.name, row
+
+
+def xlsx_rows(file: IO[bytes]) -> Iterator[Staged]:
+    """Staged rows of every sheet in the layout written by save_to_xlsx"""
+    book = openpyxl.load_workbook(file, read_only=True)
+    try:
+        for sheet in book.worksheets:
+            menu_title = submenu_title = None
+            for values in sheet.iter_rows(values_only=True):
+                row = (*values, *[None] * 6)[:6]
+                if row[0] is not None:
+                    menu_title = row[1]
+                    yield import_menu.name, (row[1], row[2])
+                elif row[1] is not None:
+                    submenu_title = row[2]
+                    yield import_submenu.name, (row[2], row[3], menu_title)
+                elif row[2] is not None:
+                    yield import_dish.name, (row[3], row[4], price(row[5]), submenu_title)
+    finally:
+        book.close()
+
+
+async def xlsx_rows_async(file: IO[bytes]) -> AsyncIterator[Staged]:
+    # the workbook is parsed in the threadpool a chunk of rows at a time
+    async for chunk in iterate_in_threadpool(chunks(xlsx_rows(file), IMPORT_CHUNK_SIZE)):
+        for staged in chunk:
+            yield staged
+
+
+async def copy_staged(connection, rows: AsyncIterator[Staged]) -> None:
+    """COPY the rows into the staging tables in batches of IMPORT_CHUNK_SIZE per table"""
+    tables = {table.name: table for table in (import_menu, import_submenu, import_dish)}
+    batches: dict[str, list[tuple[Any, ...]]] = {name: [] for name in tables}
+
+    async def flush(name: str) -> None:
+        if batches[name]:
+            # the position is numbered by the table itself in the order of the copy
+            columns = [column.name for column in tables[name].columns if column.identity is None]
+            await connection.copy_records_to_table(name, records=batches[name], columns=columns)
+            batches[name] = []
+
+    async for name, row in rows:
+        batches[name].append(row)
+        if len(batches[name]) >= IMPORT_CHUNK_SIZE:
+            await flush(name)
+    for name in tables:
+        await flush(name)
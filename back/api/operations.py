@@ -1,414 +1,668 @@
-import json
-
-from api.tasks import get_result, save_data_to_xlsx
-from db.engine import get_session
+import time
+from collections.abc import Awaitable, Callable
+from decimal import Decimal, InvalidOperation
+from functools import partial
+from typing import Any
+from uuid import uuid4
+
+from api.exporters import EXPORTERS, ExportFormat
+from api.tasks import PROGRESS, beat_key, export_claim, export_file_name
+from celery import states
+from config import (
+    EXPORT_CHUNK_SIZE,
+    EXPORT_QUEUE_TIMEOUT,
+    EXPORT_TTL,
+    SEED_CHUNK_SIZE,
+    SEED_MAX_DISHES,
+)
+from db.engine import LazySession, get_session
 from db.models import Dish, Menu, Submenu
-from fastapi import Depends
-from fastapi.encoders import jsonable_encoder
-from fastapi.responses import FileResponse
-from schemas.dish import DishCreate, DishUpdate
+from db.redis import redis_client
+from db.staging import import_dish, import_menu, import_submenu
+from fastapi import Depends, HTTPException, UploadFile, status
+from pydantic import ValidationError
+from schemas.batch import BatchEntity, BatchOp, BatchOperation
+from schemas.dish import Dish as DishSchema
+from schemas.dish import DishCreate, DishReprice, DishUpdate
+from schemas.menu import Menu as MenuSchema
 from schemas.menu import MenuCreate, MenuUpdate
+from schemas.submenu import Submenu as SubmenuSchema
 from schemas.submenu import SubmenuCreate, SubmenuUpdate
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-
-from .cache import cache
+from sqlalchemy.schema import CreateTable, DropTable
+
+from .cache import MENUS_FULL_KEY, MENUS_TAG, Invalidation, cache, dishes_tag, menu_tag, submenu_tag, submenus_tag
+from .export_backends import LOST, export_backend
+from .importer import IMPORT_ERRORS, XLSX_MEDIA_TYPE, copy_staged, json_rows, xlsx_rows_async
+from .pagination import Page
+from .responses import JSONTreeEncoder, NDJSONTreeEncoder, file_response, render
+from .seed import count_dishes, load_template, synthesize
 from .service import ServiceExc, ServiceQuery
+from .storage import export_path
 
 
-class GetSession:
-    def __init__(self, session: AsyncSession = Depends(get_session)):
-        self.session = session
+NUMERIC_VALUE_OUT_OF_RANGE = "22003"
 
 
-class MenuCrud(GetSession):
-    """Requests by menu"""
+def sqlstate(exc: DBAPIError) -> str | None:
+    """Postgres error code, set on the adapted error or on the asyncpg one it wraps"""
+    return getattr(exc.orig, "sqlstate", None) or getattr(exc.orig.__cause__, "sqlstate", None)
 
-    async def get_list(self):
-        key = "menus_list"
-        cache_menus = await cache.get(key)
 
-        if cache_menus:
-            return cache_menus
+class GetSession:
+    def __init__(self, db: LazySession = Depends(get_session)):
+        self.db = db
 
-        query = await self.session.execute(ServiceQuery.select_menu_list())
-        result = query.all()
+    async def in_transaction(self, write: Callable[..., Awaitable[tuple[Any, Invalidation]]], *args):
+        """Run one write in its own transaction, then drop what it made stale"""
+        async with self.db() as session:
+            result, invalidation = await write(session, *args)
+            await session.commit()
 
-        menus = []
-        for i in result:
-            item = None
-            item = i[0]
-            item.submenus_count = i[1]
-            item.dishes_count = i[2]
-            menus.append(item)
+        await cache.invalidate(invalidation)
+        return result
 
-        if menus:
-            await cache.set(key, menus)
 
-        return menus
+def batch_conflicts(rows: list[dict], created: list[dict]) -> list[str]:
+    """Titles of the requested rows that were not inserted, repeats included"""
+    inserted = {row["title"] for row in created}
+    conflicts = []
+    for row in rows:
+        if row["title"] in inserted:
+            inserted.discard(row["title"])
+        else:
+            conflicts.append(row["title"])
+    return conflicts
+
+
+class MenuCrud(GetSession):
+    """Requests by menu"""
+
+    async def get_list(self, page: Page):
+        return await cache.get_or_set(
+            f"menus_list:{page.key}",
+            partial(self.fetch_list, page=page),
+            tags=[MENUS_TAG],
+        )
 
     async def get_id_menu(self, menu_id: int):
-        key = f"menu_{menu_id}"
-        cache_menu = await cache.get(key)
+        menu = await cache.get_or_set(
+            f"menu_{menu_id}",
+            partial(self.fetch_menu, menu_id=menu_id),
+            tags=[menu_tag(menu_id)],
+        )
+
+        if not menu:
+            ServiceExc.not_found_404("menu")
 
-        if cache_menu:
-            return cache_menu
+        return menu
 
-        query = await self.session.execute(ServiceQuery.select_menu(menu_id))
-        result = query.first()
+    async def fetch_list(self, page: Page):
+        async with self.db() as session:
+            query = await session.execute(page.paginate(ServiceQuery.select_menu_list(), Menu))
+            menus, headers = page.split(query.scalars().all())
+        return render(list[MenuSchema], menus), headers
 
-        if result:
-            menu = result[0]
-            menu.submenus_count = result[1]
-            menu.dishes_count = result[2]
+    async def fetch_menu(self, menu_id: int):
+        async with self.db() as session:
+            query = await session.execute(ServiceQuery.select_menu(menu_id))
+            menu = query.scalars().first()
 
-            if menu:
-                await cache.set(key, menu)
+        if not menu:
+            return None
 
-            return menu
-        else:
-            ServiceExc.not_found_404("menu")
+        return render(MenuSchema, menu)
 
     async def create(self, menu_data: MenuCreate):
+        return await self.in_transaction(self.create_in, menu_data)
+
+    async def update(self, menu_id: int, menu_data: MenuUpdate):
+        return await self.in_transaction(self.update_in, menu_id, menu_data)
+
+    async def delete(self, menu_id: int):
+        return await self.in_transaction(self.delete_in, menu_id)
+
+    async def create_in(self, session: AsyncSession, menu_data: MenuCreate):
         try:
-            await cache.delete_one(["menus_list"])
-            menu_db = Menu(**menu_data.dict())
-            self.session.add(menu_db)
-            await self.session.commit()
-            await self.session.refresh(menu_db)
-            return menu_db
+            result = await session.execute(ServiceQuery.insert_menu(menu_data.dict()))
         except IntegrityError:
             ServiceExc.unique_violation("Menu")
 
-    async def update(self, menu_id: int, menu_data: MenuUpdate):
-        key = [f"menu_{menu_id}", "menus_list"]
-
-        query = await self.session.execute(ServiceQuery.select_menu(menu_id))
-        result = query.first()
-
-        if result:
-            menu = result[0]
-            menu.submenus_count = result[1]
-            menu.dishes_count = result[2]
-            menu.title = menu_data.title if menu_data.title else menu.title
-            menu.description = menu_data.description if menu_data.description else menu.description
-            self.session.add(menu)
-            await self.session.commit()
-            await self.session.refresh(menu)
-
-            await cache.delete_one(key)
-            return menu
-        else:
-            ServiceExc.not_found_404("menu")
+        return dict(result.mappings().one()), Invalidation({MENUS_TAG})
 
-    async def delete(self, menu_id: int):
-        query = await self.session.execute(ServiceQuery.select_or_delete_menu(menu_id, "select"))
-        result = query.first()
+    async def update_in(self, session: AsyncSession, menu_id: int, menu_data: MenuUpdate):
+        values = menu_data.dict(exclude_unset=True, exclude_none=True) or {"title": Menu.title}
+
+        try:
+            result = await session.execute(ServiceQuery.update_menu(menu_id, values))
+        except IntegrityError:
+            ServiceExc.unique_violation("Menu")
 
-        if not result:
+        menu = result.mappings().first()
+        if not menu:
             ServiceExc.not_found_404("menu")
 
-        await self.session.execute(ServiceQuery.select_or_delete_menu(menu_id, "delete"))
-        await self.session.commit()
+        return dict(menu), Invalidation({MENUS_TAG}, {f"menu_{menu_id}"})
 
-        key = [
-            f"menu_{menu_id}",
-            "menus_list",
-            f"submenu_{menu_id}",
-            f"dish_{menu_id}",
-        ]
-        await cache.delete_all(key)
+    async def delete_in(self, session: AsyncSession, menu_id: int):
+        result = await session.execute(ServiceQuery.select_or_delete_menu(menu_id, "delete"))
+
+        if not result.first():
+            ServiceExc.not_found_404("menu")
 
-        return {
+        deleted = {
             "status": "true",
             "message": "The menu has been deleted",
         }
+        return deleted, Invalidation({menu_tag(menu_id), MENUS_TAG})
 
 
 class SubmenuCrud(GetSession):
     """Requests by submenu"""
 
-    async def get_list(self, menu_id: int):
-        key = f"submenu_{menu_id}"
-        cache_submenus = await cache.get(key)
+    async def get_list(self, menu_id: int, page: Page):
+        return await cache.get_or_set(
+            f"submenu_{menu_id}:{page.key}",
+            partial(self.fetch_list, menu_id=menu_id, page=page),
+            tags=[menu_tag(menu_id), submenus_tag(menu_id)],
+        )
 
-        if cache_submenus:
-            return cache_submenus
+    async def get_id_submenu(self, menu_id: int, submenu_id: int):
+        submenu = await cache.get_or_set(
+            f"submenu_{menu_id}_{submenu_id}",
+            partial(self.fetch_submenu, menu_id=menu_id, submenu_id=submenu_id),
+            tags=[menu_tag(menu_id), submenu_tag(menu_id, submenu_id)],
+        )
 
-        query = await self.session.execute(ServiceQuery.select_submenu_list(menu_id))
-        result = query.all()
+        if not submenu:
+            ServiceExc.not_found_404("submenu")
 
-        submenus = []
-        for i in result:
-            item = None
-            item = i[0]
-            item.dishes_count = i[1]
-            submenus.append(item)
+        return submenu
 
-        if submenus:
-            await cache.set(key, submenus)
+    async def fetch_list(self, menu_id: int, page: Page):
+        async with self.db() as session:
+            query = await session.execute(page.paginate(ServiceQuery.select_submenu_list(menu_id), Submenu))
+            submenus, headers = page.split(query.scalars().all())
+        return render(list[SubmenuSchema], submenus), headers
 
-        return submenus
+    async def fetch_submenu(self, menu_id: int, submenu_id: int):
+        async with self.db() as session:
+            query = await session.execute(ServiceQuery.select_submenu(menu_id, submenu_id))
+            submenu = query.scalars().first()
 
-    async def get_id_submenu(self, menu_id: int, submenu_id: int):
-        key = f"submenu_{menu_id}_{submenu_id}"
-        cache_submenu = await cache.get(key)
+        if not submenu:
+            return None
 
-        if cache_submenu:
-            return cache_submenu
+        return render(SubmenuSchema, submenu)
 
-        query = await self.session.execute(ServiceQuery.select_submenu(menu_id, submenu_id))
-        result = query.first()
+    async def create(self, menu_id: int, submenu_data: SubmenuCreate):
+        return await self.in_transaction(self.create_in, menu_id, submenu_data)
 
-        if not result:
-            ServiceExc.not_found_404("submenu")
+    async def create_in(self, session: AsyncSession, menu_id: int, submenu_data: SubmenuCreate):
+        try:
+            result = await session.execute(ServiceQuery.insert_submenu(menu_id, submenu_data.dict()))
+        except IntegrityError:
+            ServiceExc.unique_violation("Submenu")
+
+        submenu = result.mappings().first()
+        if not submenu:
+            ServiceExc.not_found_404("menu")
 
-        submenu = result[0]
-        submenu.dishes_count = result[1]
+        return dict(submenu), Invalidation({MENUS_TAG, submenus_tag(menu_id)}, {f"menu_{menu_id}"})
 
-        if submenu:
-            await cache.set(key, submenu)
+    async def create_batch(self, menu_id: int, submenus_data: list[SubmenuCreate]):
+        rows = [submenu_data.dict() for submenu_data in submenus_data]
 
-        return submenu
+        async with self.db() as session:
+            menu = await session.execute(ServiceQuery.lock_menu(menu_id))
+            if not menu.first():
+                ServiceExc.not_found_404("menu")
+            result = await session.execute(ServiceQuery.insert_submenus(menu_id, rows))
+            created = [dict(submenu) for submenu in result.mappings()]
+            await session.commit()
 
-    async def create(self, menu_id: int, submenu_data: SubmenuCreate):
-        try:
-            key = [f"menu_{menu_id}", "menus_list", f"submenu_{menu_id}"]
-            await cache.delete_one(key)
+        if created:
+            await cache.delete_all([MENUS_TAG, submenus_tag(menu_id)], keys=[f"menu_{menu_id}"])
+        return {"created": created, "conflicts": batch_conflicts(rows, created)}
 
-            result = await self.session.execute(ServiceQuery.select_or_delete_menu(menu_id, "select"))
-            menu = result.first()
+    async def update(self, menu_id: int, submenu_id: int, submenu_data: SubmenuUpdate):
+        return await self.in_transaction(self.update_in, menu_id, submenu_id, submenu_data)
 
-            if not menu:
-                ServiceExc.not_found_404("menu")
+    async def delete(self, menu_id: int, submenu_id: int):
+        return await self.in_transaction(self.delete_in, menu_id, submenu_id)
 
-            submenu_db = Submenu(menu_id=menu_id, **dict(submenu_data))  # type: ignore[call-arg]
-            self.session.add(submenu_db)
-            await self.session.commit()
-            await self.session.refresh(submenu_db)
-            return submenu_db
+    async def update_in(self, session: AsyncSession, menu_id: int, submenu_id: int, submenu_data: SubmenuUpdate):
+        values = submenu_data.dict(exclude_unset=True, exclude_none=True) or {"title": Submenu.title}
+
+        try:
+            result = await session.execute(ServiceQuery.update_submenu(menu_id, submenu_id, values))
         except IntegrityError:
             ServiceExc.unique_violation("Submenu")
 
-    async def update(self, menu_id: int, submenu_id: int, submenu_data: SubmenuUpdate):
-        key = [
-            f"menu_{menu_id}",
-            "menus_list",
-            f"submenu_{menu_id}",
-            f"submenu_{menu_id}_{submenu_id}",
-        ]
-        await cache.delete_one(key)
-
-        query = await self.session.execute(ServiceQuery.select_or_del_submenu(menu_id, submenu_id, "select"))
-        submenu = query.scalars().first()
-
-        if submenu:
-            submenu.title = submenu_data.title if submenu_data.title else submenu.title
-            submenu.description = submenu_data.description if submenu_data.description else submenu.description
-            self.session.add(submenu)
-            await self.session.commit()
-            await self.session.refresh(submenu)
-            return submenu
-        else:
+        submenu = result.mappings().first()
+        if not submenu:
             ServiceExc.not_found_404("submenu")
 
-    async def delete(self, menu_id: int, submenu_id: int):
-        query = await self.session.execute(ServiceQuery.select_or_del_submenu(menu_id, submenu_id, "select"))
-        submenu = query.scalars().first()
+        return dict(submenu), Invalidation({submenus_tag(menu_id)}, {f"submenu_{menu_id}_{submenu_id}"})
 
-        if submenu:
-            key = [
-                f"menu_{menu_id}",
-                "menus_list",
-                f"submenu_{menu_id}",
-                f"submenu_{menu_id}_{submenu.id}",
-                f"dish_{menu_id}_{submenu.id}",
-            ]
-            await cache.delete_one(key)
-
-            await self.session.execute(ServiceQuery.select_or_del_submenu(menu_id, submenu_id, "delete"))
-            await self.session.commit()
-
-            return {
-                "status": "true",
-                "message": "The submenu has been deleted",
-            }
-        else:
+    async def delete_in(self, session: AsyncSession, menu_id: int, submenu_id: int):
+        result = await session.execute(ServiceQuery.select_or_del_submenu(menu_id, submenu_id, "delete"))
+
+        if not result.first():
             ServiceExc.not_found_404("submenu")
 
+        deleted = {
+            "status": "true",
+            "message": "The submenu has been deleted",
+        }
+        return deleted, Invalidation(
+            {submenu_tag(menu_id, submenu_id), submenus_tag(menu_id), MENUS_TAG},
+            {f"menu_{menu_id}"},
+        )
+
 
 class DishCrud(GetSession):
     """Requests by dish"""
 
-    async def get_list(self, menu_id: int, submenu_id: int):
-        key = f"dish_{menu_id}_{submenu_id}"
-        cache_dishes = await cache.get(key)
+    async def get_list(self, menu_id: int, submenu_id: int, page: Page):
+        return await cache.get_or_set(
+            f"dish_{menu_id}_{submenu_id}:{page.key}",
+            partial(self.fetch_list, menu_id=menu_id, submenu_id=submenu_id, page=page),
+            tags=[menu_tag(menu_id), submenu_tag(menu_id, submenu_id), dishes_tag(menu_id, submenu_id)],
+        )
 
-        if cache_dishes:
-            return cache_dishes
+    async def get_id_dish(self, menu_id: int, submenu_id: int, dish_id: int):
+        dish = await cache.get_or_set(
+            f"dish_{menu_id}_{submenu_id}_{dish_id}",
+            partial(self.fetch_dish, menu_id=menu_id, submenu_id=submenu_id, dish_id=dish_id),
+            tags=[menu_tag(menu_id), submenu_tag(menu_id, submenu_id)],
+        )
 
-        query = await self.session.execute(ServiceQuery.select_dish_list(menu_id, submenu_id))
-        dishes = query.scalars().all()
+        if not dish:
+            ServiceExc.not_found_404("dish")
 
-        if dishes:
-            await cache.set(key, dishes)
+        return dish
 
-        return dishes
+    async def fetch_list(self, menu_id: int, submenu_id: int, page: Page):
+        async with self.db() as session:
+            query = await session.execute(page.paginate(ServiceQuery.select_dish_list(menu_id, submenu_id), Dish))
+            dishes, headers = page.split(query.scalars().all())
+        return render(list[DishSchema], dishes), headers
 
-    async def get_id_dish(self, menu_id: int, submenu_id: int, dish_id: int):
-        key = f"dish_{menu_id}_{submenu_id}_{dish_id}"
-        cache_dish = await cache.get(key)
+    async def fetch_dish(self, menu_id: int, submenu_id: int, dish_id: int):
+        async with self.db() as session:
+            query = await session.execute(ServiceQuery.select_dish(menu_id, submenu_id, dish_id))
+            dish = query.scalars().first()
+
+        if not dish:
+            return None
 
-        if cache_dish:
-            return cache_dish
+        return render(DishSchema, dish)
 
-        query = await self.session.execute(ServiceQuery.select_dish(menu_id, submenu_id, dish_id))
-        dish = query.scalars().first()
+    async def create(self, menu_id: int, submenu_id: int, dish_data: DishCreate):
+        return await self.in_transaction(self.create_in, menu_id, submenu_id, dish_data)
+
+    async def create_in(self, session: AsyncSession, menu_id: int, submenu_id: int, dish_data: DishCreate):
+        try:
+            result = await session.execute(ServiceQuery.insert_dish(menu_id, submenu_id, dish_data.dict()))
+        except IntegrityError:
+            ServiceExc.unique_violation("Dish")
 
+        dish = result.mappings().first()
         if not dish:
-            ServiceExc.not_found_404("dish")
+            ServiceExc.not_found_404("submenu")
 
-        await cache.set(key, dish)
-        return dish
+        return dict(dish), Invalidation(
+            {MENUS_TAG, submenus_tag(menu_id), dishes_tag(menu_id, submenu_id)},
+            {f"menu_{menu_id}", f"submenu_{menu_id}_{submenu_id}"},
+        )
 
-    async def create(self, menu_id: int, submenu_id: int, dish_data: DishCreate):
+    async def create_batch(self, menu_id: int, submenu_id: int, dishes_data: list[DishCreate]):
         try:
-            key = [
-                f"menu_{menu_id}",
-                "menus_list",
-                f"submenu_{menu_id}",
-                f"dish_{menu_id}_{submenu_id}",
-            ]
-            await cache.delete_all(key)
-
-            query_submenu = await self.session.execute(
-                ServiceQuery.select_or_del_submenu(menu_id, submenu_id, "select")
-            )
-            submenu = query_submenu.scalars().first()
+            rows = [{**dish_data.dict(), "price": Decimal(dish_data.price)} for dish_data in dishes_data]
+        except InvalidOperation:
+            ServiceExc.bad_request("price must be a number")
 
-            if not submenu:
+        async with self.db() as session:
+            submenu = await session.execute(ServiceQuery.lock_submenu(menu_id, submenu_id))
+            if not submenu.first():
                 ServiceExc.not_found_404("submenu")
-
-            dish_db = Dish(submenu_id=submenu_id, **dict(dish_data))  # type: ignore[call-arg]
-            self.session.add(dish_db)
-            await self.session.commit()
-            await self.session.refresh(dish_db)
-            return dish_db
-        except IntegrityError:
-            ServiceExc.unique_violation("Dish")
+            result = await session.execute(ServiceQuery.insert_dishes(submenu_id, rows))
+            created = [dict(dish) for dish in result.mappings()]
+            await session.commit()
+
+        if created:
+            await cache.delete_all(
+                [MENUS_TAG, submenus_tag(menu_id), dishes_tag(menu_id, submenu_id)],
+                keys=[f"menu_{menu_id}", f"submenu_{menu_id}_{submenu_id}"],
+            )
+        return {"created": created, "conflicts": batch_conflicts(rows, created)}
 
     async def update(self, menu_id: int, submenu_id: int, dish_id: int, dish_data: DishUpdate):
-        key = [
-            f"menu_{menu_id}",
-            "menus_list",
-            f"submenu_{menu_id}",
-            f"submenu_{menu_id}_{submenu_id}",
-            f"dish_{menu_id}_{submenu_id}",
-            f"dish_{menu_id}_{submenu_id}_{dish_id}",
-        ]
-        await cache.delete_one(key)
+        return await self.in_transaction(self.update_in, menu_id, submenu_id, dish_id, dish_data)
 
-        try:
-            query = await self.session.execute(ServiceQuery.select_or_del_dish(menu_id, submenu_id, dish_id, "select"))
-            dish = query.scalars().first()
+    async def reprice(self, menu_id: int, submenu_id: int | None, reprice_data: DishReprice):
+        return await self.in_transaction(self.reprice_in, menu_id, submenu_id, reprice_data)
+
+    async def delete(self, menu_id: int, submenu_id: int, dish_id: int):
+        return await self.in_transaction(self.delete_in, menu_id, submenu_id, dish_id)
+
+    async def update_in(
+        self,
+        session: AsyncSession,
+        menu_id: int,
+        submenu_id: int,
+        dish_id: int,
+        dish_data: DishUpdate,
+    ):
+        values = dish_data.dict(exclude_unset=True, exclude_none=True) or {"title": Dish.title}
 
-            dish.title = dish_data.title if dish_data.title else dish.title
-            dish.description = dish_data.description if dish_data.description else dish.description
-            dish.price = dish_data.price if dish_data.price else dish.price
-            self.session.add(dish)
-            await self.session.commit()
-            await self.session.refresh(dish)
-            return dish
+        try:
+            result = await session.execute(ServiceQuery.update_dish(menu_id, submenu_id, dish_id, values))
         except IntegrityError:
             ServiceExc.unique_violation("Dish")
-        except AttributeError:
+
+        dish = result.mappings().first()
+        if not dish:
             ServiceExc.not_found_404("dish")
 
-    async def delete(self, menu_id: int, submenu_id: int, dish_id: int):
+        return dict(dish), Invalidation(
+            {dishes_tag(menu_id, submenu_id)},
+            {f"dish_{menu_id}_{submenu_id}_{dish_id}"},
+        )
+
+    async def reprice_in(
+        self,
+        session: AsyncSession,
+        menu_id: int,
+        submenu_id: int | None,
+        reprice_data: DishReprice,
+    ):
+        query = ServiceQuery.reprice_dishes(menu_id, submenu_id, reprice_data.percent, reprice_data.delta)
         try:
-            query = await self.session.execute(ServiceQuery.select_or_del_dish(menu_id, submenu_id, dish_id, "select"))
-            dish = query.scalars().first()
+            repriced = (await session.execute(query)).scalars().all()
+        except DBAPIError as exc:
+            # asyncpg overflows surface as a plain DBAPIError, told apart by their sqlstate only
+            if sqlstate(exc) != NUMERIC_VALUE_OUT_OF_RANGE:
+                raise
+            ServiceExc.bad_request("the new prices do not fit the price column")
+
+        if not repriced:
+            if submenu_id is None:
+                parent = await session.execute(ServiceQuery.lock_menu(menu_id))
+            else:
+                parent = await session.execute(ServiceQuery.lock_submenu(menu_id, submenu_id))
+            if not parent.first():
+                ServiceExc.not_found_404("menu" if submenu_id is None else "submenu")
+
+        # prices only show in dish entries, all of which carry the tag of their submenu
+        tags = {submenu_tag(menu_id, repriced_submenu) for repriced_submenu in set(repriced)}
+        return {"updated": len(repriced)}, Invalidation(tags)
+
+    async def delete_in(self, session: AsyncSession, menu_id: int, submenu_id: int, dish_id: int):
+        result = await session.execute(ServiceQuery.select_or_del_dish(menu_id, submenu_id, dish_id, "delete"))
+
+        if not result.first():
+            ServiceExc.not_found_404("dish")
 
-            key = [
+        deleted = {
+            "status": "true",
+            "message": "The dish has been deleted",
+        }
+        return deleted, Invalidation(
+            {MENUS_TAG, submenus_tag(menu_id), dishes_tag(menu_id, submenu_id)},
+            {
                 f"menu_{menu_id}",
-                "menus_list",
-                f"submenu_{menu_id}",
                 f"submenu_{menu_id}_{submenu_id}",
-                f"dish_{menu_id}_{submenu_id}",
-                f"dish_{menu_id}_{submenu_id}_{dish.id}",
-            ]
-            await cache.delete_one(key)
-
-            await self.session.execute(ServiceQuery.select_or_del_dish(menu_id, submenu_id, dish_id, "delete"))
-            await self.session.commit()
-
-            return {
-                "status": "true",
-                "message": "The dish has been deleted",
-            }
-        except AttributeError:
-            ServiceExc.not_found_404("dish")
+                f"dish_{menu_id}_{submenu_id}_{dish_id}",
+            },
+        )
+
+
+class BatchCrud(GetSession):
+    """Ordered writes on menus, submenus and dishes applied in one transaction"""
+
+    async def run(self, operations: list[BatchOperation]):
+        results: list[dict[str, Any]] = []
+        invalidation = Invalidation()
+
+        async with self.db() as session:
+            for index, operation in enumerate(operations):
+                try:
+                    result, stale = await self.apply(session, operation, results)
+                except HTTPException as exc:
+                    raise HTTPException(exc.status_code, {"operation": index, "detail": exc.detail}) from exc
+                results.append(result)
+                invalidation |= stale
+            await session.commit()
+
+        # one round trip for the whole batch, and only once the writes are visible
+        await cache.invalidate(invalidation)
+        return {"results": results}
+
+    async def apply(self, session: AsyncSession, operation: BatchOperation, results: list[dict[str, Any]]):
+        crud, schema, create_schema, update_schema, parents = {
+            BatchEntity.menu: (MenuCrud, MenuSchema, MenuCreate, MenuUpdate, ()),
+            BatchEntity.submenu: (SubmenuCrud, SubmenuSchema, SubmenuCreate, SubmenuUpdate, ("menu_id",)),
+            BatchEntity.dish: (DishCrud, DishSchema, DishCreate, DishUpdate, ("menu_id", "submenu_id")),
+        }[operation.entity]
+        ops = crud(self.db)
+        args = [self.resolve(operation, name, results) for name in parents]
+
+        try:
+            match operation.op:
+                case BatchOp.create:
+                    result, stale = await ops.create_in(session, *args, create_schema(**operation.data))
+                case BatchOp.update:
+                    entity_id = self.resolve(operation, "id", results)
+                    result, stale = await ops.update_in(session, *args, entity_id, update_schema(**operation.data))
+                case BatchOp.delete:
+                    return await ops.delete_in(session, *args, self.resolve(operation, "id", results))
+        except ValidationError as exc:
+            raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, exc.errors()) from exc
+
+        return schema.parse_obj(result).dict(), stale
+
+    @staticmethod
+    def resolve(operation: BatchOperation, name: str, results: list[dict[str, Any]]) -> int:
+        ref = getattr(operation, name)
+        if ref is None:
+            ServiceExc.bad_request(f"{name} is required")
+        if isinstance(ref, int):
+            return ref
+
+        index = int(ref[1:])
+        if index >= len(results) or "id" not in results[index]:
+            ServiceExc.bad_request(f"{ref} does not refer to an entity returned earlier in the batch")
+        return int(results[index]["id"])
 
 
 class TestMenu(GetSession):
     """Generate test data finto DB"""
 
-    async def create_test_menu(self):
-        with open("./generate_data.json") as file:
-            menus = json.load(file)
+    async def create_test_menu(self, menus: int | None = None, submenus: int | None = None, dishes: int | None = None):
+        template = load_template()
+        if count_dishes(template, menus, submenus, dishes) > SEED_MAX_DISHES:
+            ServiceExc.bad_request(f"at most {SEED_MAX_DISHES} dishes can be generated at once")
+        tree = synthesize(template, menus, submenus, dishes)
 
-        for menu in menus:
-            menu_create = await ServiceQuery.add_test_data(
-                title=menu["title"],
-                desc=menu["description"],
-                table="menu",
-                db=self.session,
-            )
-            for submenu in menu["submenus"]:
-                submenu_create = await ServiceQuery.add_test_data(
-                    title=submenu["title"],
-                    desc=submenu["description"],
-                    table="submenu",
-                    db=self.session,
-                    id=menu_create.id,
+        try:
+            async with self.db() as session:
+                menu_ids = await self.insert_chunks(
+                    session,
+                    Menu,
+                    [{"title": menu["title"], "description": menu["description"]} for menu in tree],
+                )
+                submenu_ids = await self.insert_chunks(
+                    session,
+                    Submenu,
+                    [
+                        {
+                            "title": submenu["title"],
+                            "description": submenu["description"],
+                            "menu_id": menu_ids[menu["title"]],
+                        }
+                        for menu in tree
+                        for submenu in menu["submenus"]
+                    ],
                 )
-                for dish in submenu["dishes"]:
-                    await ServiceQuery.add_test_data(
-                        title=dish["title"],
-                        desc=dish["description"],
-                        price=dish["price"],
-                        table="dish",
-                        db=self.session,
-                        id=submenu_create.id,
-                    )
+                await self.insert_chunks(
+                    session,
+                    Dish,
+                    [
+                        {**dish, "submenu_id": submenu_ids[submenu["title"]]}
+                        for menu in tree
+                        for submenu in menu["submenus"]
+                        for dish in submenu["dishes"]
+                    ],
+                )
+                await session.commit()
+        except IntegrityError:
+            ServiceExc.unique_violation("Test data")
 
+        await cache.delete_all([MENUS_TAG])
         return {"Message": "The database is full"}
 
+    @staticmethod
+    async def insert_chunks(session, model, rows: list[dict]) -> dict[str, int]:
+        """Insert rows by chunks of multi-row statements, ids of the new rows by title"""
+        ids: dict[str, int] = {}
+        for start in range(0, len(rows), SEED_CHUNK_SIZE):
+            result = await session.execute(ServiceQuery.insert_many(model, rows[start:start + SEED_CHUNK_SIZE]))
+            ids.update((title, id) for id, title in result.all())
+        return ids
+
+
+class ImportMenu(GetSession):
+    """Load a whole menu tree by title through staging tables"""
+
+    async def import_tree(self, upload: UploadFile):
+        is_xlsx = upload.content_type == XLSX_MEDIA_TYPE or (upload.filename or "").endswith(".xlsx")
+        rows = xlsx_rows_async(upload.file) if is_xlsx else json_rows(upload)
+
+        async with self.db() as session:
+            connection = await session.connection()
+            try:
+                for table in (import_menu, import_submenu, import_dish):
+                    # a commit of a session joined to an outer transaction does not drop them
+                    await connection.execute(DropTable(table, if_exists=True))
+                    await connection.execute(CreateTable(table))
+                raw_connection = await connection.get_raw_connection()
+                await copy_staged(raw_connection.driver_connection, rows)
+
+                result = {}
+                for name, query in (
+                    ("menus", ServiceQuery.upsert_imported_menus()),
+                    ("submenus", ServiceQuery.upsert_imported_submenus()),
+                    ("dishes", ServiceQuery.upsert_imported_dishes()),
+                ):
+                    counts = await session.execute(query)
+                    result[name] = dict(counts.mappings().one())
+            except IMPORT_ERRORS:
+                ServiceExc.bad_request("the file does not hold a valid menu tree")
+
+            menu_ids = await session.execute(ServiceQuery.select_imported_menu_ids())
+            tags = [menu_tag(menu_id) for menu_id in menu_ids.scalars()]
+            await session.commit()
+
+        await cache.delete_all([MENUS_TAG, *tags])
+        return result
+
 
 class AllMenu(GetSession):
     """Request all menu from db"""
 
-    async def all_menu(self):
-        query_result = await self.session.execute(ServiceQuery.get_all_menu())
-        result = jsonable_encoder(query_result.scalars().unique().all())
-
-        return result
+    async def get_full(self):
+        return await cache.get_or_set(MENUS_FULL_KEY, self.fetch_full)
+
+    async def fetch_full(self):
+        encoder = JSONTreeEncoder(counts=True)
+        async with self.db() as session:
+            result = await session.execute(ServiceQuery.select_menu_full())
+            body = b"".join(encoder.encode(record) for record in result)
+        return encoder.start() + body + encoder.end()
+
+    async def stream_tree(self, encoder: JSONTreeEncoder | NDJSONTreeEncoder):
+        """Encoded tree read through a server-side cursor, one chunk of rows at a time"""
+        async with self.db() as session:
+            result = await session.stream(ServiceQuery.select_menu_tree())
+            yield encoder.start()
+            async for chunk in result.partitions(EXPORT_CHUNK_SIZE):
+                yield b"".join(encoder.encode(record) for record in chunk)
+            yield encoder.end()
+
+
+# Drop the claim only while it still names the given task, so a claim taken meanwhile survives
+RELEASE_CLAIM_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+release_claim = redis_client.register_script(RELEASE_CLAIM_SCRIPT)
+
+
+class TaskMenu:
+    """Export of the menu tree by the configured export backend"""
+
+    async def all_data_to_file(self, file_format: ExportFormat):
+        version = await cache.data_version()
+        key = export_claim(version, file_format.value)
+        task_id = str(uuid4())
+        # the submit time stands for the first heartbeat until a worker picks the task up
+        await redis_client.set(beat_key(task_id), int(time.time()), ex=EXPORT_TTL)
+
+        # requests for the same data version share one task and its file;
+        # the claim outlives the queue wait, and once started the worker keeps it shorter
+        while not await redis_client.set(key, task_id, nx=True, ex=EXPORT_QUEUE_TIMEOUT):
+            current = await redis_client.get(key)
+            if current and await self.reusable(current.decode(), version, file_format):
+                await redis_client.delete(beat_key(task_id))
+                return {"status": "True", "task id": {current.decode()}}
+            if current:
+                await release_claim(keys=[key], args=[current])
 
-
-class TaskMenu(AllMenu):
-    async def all_data_to_file(self):
-        data = await self.all_menu()
-        task = save_data_to_xlsx.delay(data)
-        return {"status": "True", "task id": {task.id}}
-
-    def get_data_to_file(self, task_id: str):
-        task = get_result(task_id)
-        if task.ready():
-            filename = task.result["file_name"]
-            return FileResponse(
-                path=f"/app/task_files/{filename}",
-                media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                headers={"Content-Disposition": f"attachment; filename={filename}"},
-            )
+        try:
+            export_backend.submit(task_id, version, file_format.value)
+        except Exception:
+            await release_claim(keys=[key], args=[task_id])
+            raise
+        return {"status": "True", "task id": {task_id}}
+
+    async def reusable(self, task_id: str, version: int, file_format: ExportFormat) -> bool:
+        """The task is still alive or has left its file in place"""
+        state, _ = await export_backend.status(task_id)
+        if state == LOST:
+            return False
+        if state not in states.READY_STATES:
+            return not await export_backend.stalled(task_id, state)
+        return state == states.SUCCESS and export_path(export_file_name(version, file_format)).exists()
+
+    async def get_data_to_file(
+        self,
+        task_id: str,
+        wait: int = 0,
+        range_header: str | None = None,
+        if_range: str | None = None,
+        accept_encoding: str | None = None,
+    ):
+        state, info = await export_backend.status(task_id)
+        running = state not in states.READY_STATES and state != LOST
+        if wait and running and not await export_backend.stalled(task_id, state):
+            await export_backend.wait(task_id, wait)
+            state, info = await export_backend.status(task_id)
+            running = state not in states.READY_STATES and state != LOST
+
+        if running and await export_backend.stalled(task_id, state):
+            state = LOST
+        if state == states.SUCCESS:
+            path = export_path(info["file_name"])
+            if not path.exists():
+                ServiceExc.not_found_404("file")
+            media_type = EXPORTERS[ExportFormat(info["format"])].media_type
+            return file_response(path, media_type, range_header, if_range, accept_encoding)
+        elif state == PROGRESS:
+            return {"task_id": task_id, "status": state, "progress": info}
         else:
-            return {"task_id": task_id, "status": task.status}
+            return {"task_id": task_id, "status": state}
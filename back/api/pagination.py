@@ -0,0 +1,71 @@
+import base64
+import binascii
+from enum import Enum
+from typing import Any
+
+import orjson
+from config import PAGE_LIMIT_DEFAULT, PAGE_LIMIT_MAX
+from fastapi import Query
+
+from .service import ServiceExc
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+class Order(str, Enum):
+    id = "id"
+    id_desc = "-id"
+    title = "title"
+    title_desc = "-title"
+
+
+class Page:
+    """Keyset page of a list endpoint.
+
+    Both sort columns are unique, so the last value of the page is enough
+    to continue after it.
+    """
+
+    def __init__(
+        self,
+        limit: int = Query(default=PAGE_LIMIT_DEFAULT, ge=1, le=PAGE_LIMIT_MAX),
+        cursor: str | None = Query(default=None),
+        order: Order = Query(default=Order.id),
+    ):
+        self.limit = limit
+        self.cursor = cursor
+        self.order = order
+        self.field = order.value.lstrip("-")
+        self.descending = order.value.startswith("-")
+        self.after = self.decode(cursor) if cursor else None
+
+    @property
+    def key(self) -> str:
+        """Part of the cache key that identifies the page"""
+        return f"{self.order.value}:{self.limit}:{self.cursor or ''}"
+
+    def paginate(self, query: Any, model: Any) -> Any:
+        column = getattr(model, self.field)
+        if self.after is not None:
+            query = query.filter(column < self.after if self.descending else column > self.after)
+        return query.order_by(column.desc() if self.descending else column).limit(self.limit + 1)
+
+    def split(self, rows: list[Any]) -> tuple[list[Any], dict[str, str]]:
+        """Rows of the page and the header pointing to the next one"""
+        if len(rows) <= self.limit:
+            return rows, {}
+        rows = rows[: self.limit]
+        return rows, {NEXT_CURSOR_HEADER: self.encode(getattr(rows[-1], self.field))}
+
+    @staticmethod
+    def encode(value: Any) -> str:
+        return base64.urlsafe_b64encode(orjson.dumps(value)).decode()
+
+    def decode(self, cursor: str) -> Any:
+        try:
+            value = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (binascii.Error, orjson.JSONDecodeError, ValueError):
+            ServiceExc.bad_request("invalid cursor")
+        if not isinstance(value, int if self.field == "id" else str):
+            ServiceExc.bad_request("invalid cursor")
+        return value
@@ -0,0 +1,233 @@
+import re
+from collections.abc import AsyncIterator
+from enum import Enum
+from pathlib import Path
+from typing import Any
+
+import anyio
+import orjson
+from config import HTTP_CACHE_MAX_AGE
+from fastapi import status
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, parse_obj_as
+from sqlalchemy.engine import Row
+
+from .cache import CacheEntry
+from .storage import gzip_path, touch
+
+CACHE_CONTROL = f"max-age={HTTP_CACHE_MAX_AGE}, must-revalidate"
+FILE_CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class RawJSONResponse(Response):
+    """Response with an already encoded JSON body"""
+
+    media_type = "application/json"
+
+
+def render(schema: Any, obj: Any) -> bytes:
+    """Validate obj through the response schema and encode it to JSON"""
+    return orjson.dumps(parse_obj_as(schema, obj), default=BaseModel.dict)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def cached_response(entry: CacheEntry, if_none_match: str | None = None) -> Response:
+    """Cached body, or 304 when the client already holds its ETag"""
+    headers = {**entry.headers, "ETag": entry.etag, "Cache-Control": CACHE_CONTROL}
+    if if_none_match and etag_matches(if_none_match, entry.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return RawJSONResponse(entry.body, headers=headers)
+
+
+def byte_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """Inclusive bounds of a single byte range; None means the whole file"""
+    match = RANGE_RE.fullmatch(range_header.strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        return max(size - int(last), 0), size - 1
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+async def read_file(path: Path, start: int, length: int) -> AsyncIterator[bytes]:
+    async with await anyio.open_file(path, "rb") as file:
+        await file.seek(start)
+        while length > 0:
+            chunk = await file.read(min(FILE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def file_response(
+    path: Path,
+    media_type: str,
+    range_header: str | None = None,
+    if_range: str | None = None,
+    accept_encoding: str | None = None,
+) -> Response:
+    """Download of an export file, resumable with Range and gzipped when a copy exists"""
+    headers = {
+        "Content-Disposition": f"attachment; filename={path.name}",
+        "Accept-Ranges": "bytes",
+        "Vary": "Accept-Encoding",
+    }
+    if accept_encoding and "gzip" in accept_encoding and gzip_path(path).exists():
+        path = gzip_path(path)
+        headers["Content-Encoding"] = "gzip"
+
+    stat = path.stat()
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers["ETag"] = etag
+    touch(path)
+
+    bounds = byte_range(range_header, stat.st_size) if range_header else None
+    if bounds is None or (if_range and if_range.strip() != etag):
+        headers["Content-Length"] = str(stat.st_size)
+        return StreamingResponse(read_file(path, 0, stat.st_size), media_type=media_type, headers=headers)
+
+    start, end = bounds
+    if start > end:
+        headers["Content-Range"] = f"bytes */{stat.st_size}"
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+    headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        read_file(path, start, end - start + 1),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+class TreeFormat(str, Enum):
+    json = "json"
+    ndjson = "ndjson"
+
+
+def dumps(obj: dict[str, Any]) -> bytes:
+    # ids and prices are strings in every response schema
+    return orjson.dumps({key: str(value) if key in ("id", "price") else value for key, value in obj.items()})
+
+
+class JSONTreeEncoder:
+    """Nested JSON array of the menu tree, encoded piece by piece from ordered rows"""
+
+    media_type = "application/json"
+
+    def __init__(self, counts: bool = False):
+        self.counts = counts
+        self.menu_id = self.submenu_id = None
+        self.first_dish = True
+
+    def start(self) -> bytes:
+        return b"["
+
+    def encode(self, record: Row) -> bytes:
+        parts = []
+        if record.menu_id != self.menu_id:
+            if self.menu_id is not None:
+                parts.append(self.close_menu() + b",")
+            self.menu_id = record.menu_id
+            menu = {
+                "id": record.menu_id,
+                "title": record.menu_title,
+                "description": record.menu_description,
+            }
+            if self.counts:
+                menu.update(submenus_count=record.submenus_count, dishes_count=record.dishes_count)
+            parts.append(dumps(menu)[:-1] + b',"submenus":[')
+        if record.submenu_id is not None and record.submenu_id != self.submenu_id:
+            if self.submenu_id is not None:
+                parts.append(b"]},")
+            self.submenu_id, self.first_dish = record.submenu_id, True
+            submenu = {
+                "id": record.submenu_id,
+                "title": record.submenu_title,
+                "description": record.submenu_description,
+            }
+            if self.counts:
+                submenu.update(dishes_count=record.submenu_dishes_count)
+            parts.append(dumps(submenu)[:-1] + b',"dishes":[')
+        if record.dish_id is not None:
+            if not self.first_dish:
+                parts.append(b",")
+            self.first_dish = False
+            dish = {
+                "id": record.dish_id,
+                "title": record.dish_title,
+                "description": record.dish_description,
+                "price": record.dish_price,
+            }
+            parts.append(dumps(dish))
+        return b"".join(parts)
+
+    def close_menu(self) -> bytes:
+        closed = b"]}" if self.submenu_id is not None else b""
+        self.submenu_id = None
+        return closed + b"]}"
+
+    def end(self) -> bytes:
+        return (self.close_menu() if self.menu_id is not None else b"") + b"]"
+
+
+class NDJSONTreeEncoder:
+    """One line per menu, submenu and dish of the tree, parents first"""
+
+    media_type = "application/x-ndjson"
+
+    def __init__(self):
+        self.menu_id = self.submenu_id = None
+
+    def start(self) -> bytes:
+        return b""
+
+    def encode(self, record: Row) -> bytes:
+        lines = []
+        if record.menu_id != self.menu_id:
+            self.menu_id, self.submenu_id = record.menu_id, None
+            menu = {
+                "type": "menu",
+                "id": record.menu_id,
+                "title": record.menu_title,
+                "description": record.menu_description,
+            }
+            lines.append(dumps(menu))
+        if record.submenu_id is not None and record.submenu_id != self.submenu_id:
+            self.submenu_id = record.submenu_id
+            submenu = {
+                "type": "submenu",
+                "id": record.submenu_id,
+                "menu_id": str(record.menu_id),
+                "title": record.submenu_title,
+                "description": record.submenu_description,
+            }
+            lines.append(dumps(submenu))
+        if record.dish_id is not None:
+            dish = {
+                "type": "dish",
+                "id": record.dish_id,
+                "submenu_id": str(record.submenu_id),
+                "title": record.dish_title,
+                "description": record.dish_description,
+                "price": record.dish_price,
+            }
+            lines.append(dumps(dish))
+        return b"".join(line + b"\n" for line in lines)
+
+    def end(self) -> bytes:
+        return b""
+
+
+TREE_ENCODERS = {
+    TreeFormat.json: JSONTreeEncoder,
+    TreeFormat.ndjson: NDJSONTreeEncoder,
+}
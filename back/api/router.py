@@ -1,20 +1,34 @@
-from db import models
-from db.redis import redis_client
-from fastapi import APIRouter, Depends, status
-from schemas.dish import Dish, DishCreate, DishDelete, DishUpdate
+from config import BATCH_MAX_ITEMS, EXPORT_WAIT_MAX
+from db.pool import pool_stats
+from fastapi import APIRouter, Body, Depends, File, Header, Query, UploadFile, status
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from schemas.batch import BatchOperation, BatchResult
+from schemas.dish import Dish, DishBatch, DishCreate, DishDelete, DishReprice, DishRepriceResult, DishUpdate
 from schemas.menu import Menu, MenuCreate, MenuDelete, MenuUpdate
-from schemas.submenu import Submenu, SubmenuCreate, SubmenuDelete, SubmenuUpdate
+from schemas.submenu import Submenu, SubmenuBatch, SubmenuCreate, SubmenuDelete, SubmenuUpdate
 
-from .operations import DishCrud, MenuCrud, SubmenuCrud, TaskMenu, TestMenu
+from .cache import cache
+from .export_backends import export_backend
+from .exporters import ExportFormat
+from .operations import AllMenu, BatchCrud, DishCrud, ImportMenu, MenuCrud, SubmenuCrud, TaskMenu, TestMenu
+from .pagination import Page
+from .responses import TREE_ENCODERS, TreeFormat, cached_response
 
 router = APIRouter(
     prefix="/api/v1",
+    default_response_class=ORJSONResponse,
 )
 
 
 @router.on_event("startup")
 async def startup():
-    redis_client
+    cache.start_listener()
+
+
+@router.on_event("shutdown")
+async def shutdown():
+    await cache.stop_listener()
+    export_backend.shutdown()
 
 
 @router.get(
@@ -23,8 +37,38 @@ async def startup():
     tags=["menu"],
     summary="Список меню",
 )
-async def get_menu_list(menu: MenuCrud = Depends()) -> list[models.Menu]:
-    return await menu.get_list()
+async def get_menu_list(
+    page: Page = Depends(),
+    menu: MenuCrud = Depends(),
+    if_none_match: str | None = Header(default=None),
+) -> Response:
+    return cached_response(await menu.get_list(page), if_none_match)
+
+
+@router.get(
+    "/menus/full",
+    tags=["menu"],
+    summary="Всё дерево меню с количеством подменю и блюд",
+)
+async def get_menu_full(
+    all_menu: AllMenu = Depends(),
+    if_none_match: str | None = Header(default=None),
+) -> Response:
+    return cached_response(await all_menu.get_full(), if_none_match)
+
+
+@router.get(
+    "/menus/tree",
+    response_class=StreamingResponse,
+    tags=["menu"],
+    summary="Всё дерево меню потоком",
+)
+async def get_menu_tree(
+    tree_format: TreeFormat = Query(default=TreeFormat.json, alias="format"),
+    all_menu: AllMenu = Depends(),
+) -> StreamingResponse:
+    encoder = TREE_ENCODERS[tree_format]()
+    return StreamingResponse(all_menu.stream_tree(encoder), media_type=encoder.media_type)
 
 
 @router.get(
@@ -33,8 +77,12 @@ async def get_menu_list(menu: MenuCrud = Depends()) -> list[models.Menu]:
     tags=["menu"],
     summary="Конкретное меню",
 )
-async def get_menu(menu_id: int, menu: MenuCrud = Depends()) -> models.Menu:
-    return await menu.get_id_menu(menu_id)
+async def get_menu(
+    menu_id: int,
+    menu: MenuCrud = Depends(),
+    if_none_match: str | None = Header(default=None),
+) -> Response:
+    return cached_response(await menu.get_id_menu(menu_id), if_none_match)
 
 
 @router.post(
@@ -75,8 +123,13 @@ async def delete_menu(menu_id: int, menu: MenuCrud = Depends()):
     tags=["submenu"],
     summary="Список подменю",
 )
-async def get_submenu_list(menu_id: int, submenu: SubmenuCrud = Depends()) -> list[models.Submenu]:
-    return await submenu.get_list(menu_id)
+async def get_submenu_list(
+    menu_id: int,
+    page: Page = Depends(),
+    submenu: SubmenuCrud = Depends(),
+    if_none_match: str | None = Header(default=None),
+) -> Response:
+    return cached_response(await submenu.get_list(menu_id, page), if_none_match)
 
 
 @router.get(
@@ -85,8 +138,13 @@ async def get_submenu_list(menu_id: int, submenu: SubmenuCrud = Depends()) -> li
     tags=["submenu"],
     summary="Конкрентное подменю",
 )
-async def get_submenu(menu_id: int, submenu_id: int, submenu: SubmenuCrud = Depends()) -> models.Submenu:
-    return await submenu.get_id_submenu(menu_id, submenu_id)
+async def get_submenu(
+    menu_id: int,
+    submenu_id: int,
+    submenu: SubmenuCrud = Depends(),
+    if_none_match: str | None = Header(default=None),
+) -> Response:
+    return cached_response(await submenu.get_id_submenu(menu_id, submenu_id), if_none_match)
 
 
 @router.post(
@@ -100,6 +158,21 @@ async def create_submenu(menu_id: int, submenu_data: SubmenuCreate, submenu: Sub
     return await submenu.create(menu_id, submenu_data)
 
 
+@router.post(
+    "/menus/{menu_id}/submenus:batch",
+    response_model=SubmenuBatch,
+    status_code=status.HTTP_201_CREATED,
+    tags=["submenu"],
+    summary="Создание нескольких подменю",
+)
+async def create_submenu_batch(
+    menu_id: int,
+    submenus_data: list[SubmenuCreate] = Body(min_items=1, max_items=BATCH_MAX_ITEMS),
+    submenu: SubmenuCrud = Depends(),
+) -> SubmenuBatch:
+    return await submenu.create_batch(menu_id, submenus_data)
+
+
 @router.patch(
     "/menus/{menu_id}/submenus/{submenu_id}",
     response_model=Submenu,
@@ -132,8 +205,14 @@ async def delete_submenu(menu_id: int, submenu_id: int, submenu: SubmenuCrud = D
     tags=["dish"],
     summary="Список блюд",
 )
-async def get_dish_list(menu_id: int, submenu_id: int, dish: DishCrud = Depends()) -> list[models.Dish]:
-    return await dish.get_list(menu_id, submenu_id)
+async def get_dish_list(
+    menu_id: int,
+    submenu_id: int,
+    page: Page = Depends(),
+    dish: DishCrud = Depends(),
+    if_none_match: str | None = Header(default=None),
+) -> Response:
+    return cached_response(await dish.get_list(menu_id, submenu_id, page), if_none_match)
 
 
 @router.get(
@@ -142,8 +221,14 @@ async def get_dish_list(menu_id: int, submenu_id: int, dish: DishCrud = Depends(
     tags=["dish"],
     summary="Конкрентное блюдо",
 )
-async def get_dish(menu_id: int, submenu_id: int, dish_id: int, dish: DishCrud = Depends()) -> models.Dish:
-    return await dish.get_id_dish(menu_id, submenu_id, dish_id)
+async def get_dish(
+    menu_id: int,
+    submenu_id: int,
+    dish_id: int,
+    dish: DishCrud = Depends(),
+    if_none_match: str | None = Header(default=None),
+) -> Response:
+    return cached_response(await dish.get_id_dish(menu_id, submenu_id, dish_id), if_none_match)
 
 
 @router.post(
@@ -162,6 +247,47 @@ async def create_dish(
     return await dish.create(menu_id, submenu_id, dish_data)
 
 
+@router.post(
+    "/menus/{menu_id}/submenus/{submenu_id}/dishes:batch",
+    response_model=DishBatch,
+    status_code=status.HTTP_201_CREATED,
+    tags=["dish"],
+    summary="Создание нескольких блюд",
+)
+async def create_dish_batch(
+    menu_id: int,
+    submenu_id: int,
+    dishes_data: list[DishCreate] = Body(min_items=1, max_items=BATCH_MAX_ITEMS),
+    dish: DishCrud = Depends(),
+) -> DishBatch:
+    return await dish.create_batch(menu_id, submenu_id, dishes_data)
+
+
+@router.post(
+    "/menus/{menu_id}/dishes:reprice",
+    response_model=DishRepriceResult,
+    tags=["dish"],
+    summary="Изменение цен всех блюд меню",
+)
+async def reprice_menu_dishes(menu_id: int, reprice_data: DishReprice, dish: DishCrud = Depends()) -> DishRepriceResult:
+    return await dish.reprice(menu_id, None, reprice_data)
+
+
+@router.post(
+    "/menus/{menu_id}/submenus/{submenu_id}/dishes:reprice",
+    response_model=DishRepriceResult,
+    tags=["dish"],
+    summary="Изменение цен всех блюд подменю",
+)
+async def reprice_submenu_dishes(
+    menu_id: int,
+    submenu_id: int,
+    reprice_data: DishReprice,
+    dish: DishCrud = Depends(),
+) -> DishRepriceResult:
+    return await dish.reprice(menu_id, submenu_id, reprice_data)
+
+
 @router.patch(
     "/menus/{menu_id}/submenus/{submenu_id}/dishes/{dish_id}",
     response_model=Dish,
@@ -189,14 +315,43 @@ async def delete_dish(menu_id: int, submenu_id: int, dish_id: int, dish: DishCru
     return await dish.delete(menu_id, submenu_id, dish_id)
 
 
+@router.post(
+    "/batch",
+    response_model=BatchResult,
+    status_code=status.HTTP_200_OK,
+    tags=["batch"],
+    summary="Набор изменений меню, подменю и блюд в одной транзакции",
+)
+async def run_batch(
+    operations: list[BatchOperation] = Body(min_items=1, max_items=BATCH_MAX_ITEMS),
+    batch: BatchCrud = Depends(),
+) -> BatchResult:
+    return await batch.run(operations)
+
+
 @router.get(
     "/generate_data",
     status_code=status.HTTP_200_OK,
     tags=["test_data"],
     summary="Автогенерация тестовых данных в БД",
 )
-async def generate_data_db(test_menu: TestMenu = Depends()):
-    return await test_menu.create_test_menu()
+async def generate_data_db(
+    menus: int | None = Query(default=None, ge=1),
+    submenus: int | None = Query(default=None, ge=1),
+    dishes: int | None = Query(default=None, ge=1),
+    test_menu: TestMenu = Depends(),
+):
+    return await test_menu.create_test_menu(menus, submenus, dishes)
+
+
+@router.post(
+    "/import",
+    status_code=status.HTTP_200_OK,
+    tags=["import"],
+    summary="Загрузка дерева меню из JSON или XLSX",
+)
+async def import_menu_tree(file: UploadFile = File(), importer: ImportMenu = Depends()):
+    return await importer.import_tree(file)
 
 
 @router.post(
@@ -205,8 +360,11 @@ async def generate_data_db(test_menu: TestMenu = Depends()):
     tags=["download_menu"],
     summary="Создание задачи на получения меню",
 )
-async def create_task_full_menu(task_worker: TaskMenu = Depends()):
-    return await task_worker.all_data_to_file()
+async def create_task_full_menu(
+    file_format: ExportFormat = Query(default=ExportFormat.xlsx, alias="format"),
+    task_worker: TaskMenu = Depends(),
+):
+    return await task_worker.all_data_to_file(file_format)
 
 
 @router.get(
@@ -215,5 +373,23 @@ async def create_task_full_menu(task_worker: TaskMenu = Depends()):
     tags=["download_menu"],
     summary="Получение ссылки на файла",
 )
-async def get_download_file(task_id: str, task_worker: TaskMenu = Depends()):
-    return task_worker.get_data_to_file(task_id)
+async def get_download_file(
+    task_id: str,
+    wait: int = Query(default=0, ge=0, le=EXPORT_WAIT_MAX),
+    task_worker: TaskMenu = Depends(),
+    range_header: str | None = Header(default=None, alias="Range"),
+    if_range: str | None = Header(default=None),
+    accept_encoding: str | None = Header(default=None),
+):
+    return await task_worker.get_data_to_file(task_id, wait, range_header, if_range, accept_encoding)
+
+
+@router.get(
+    path="/_internal/pool",
+    status_code=status.HTTP_200_OK,
+    tags=["internal"],
+    summary="Состояние пула соединений с БД",
+    include_in_schema=False,
+)
+async def get_pool_stats():
+    return pool_stats.snapshot()
@@ -0,0 +1,75 @@
+import json
+from decimal import Decimal
+from typing import Any
+
+TEMPLATE_PATH = "./generate_data.json"
+
+
+def load_template(path: str = TEMPLATE_PATH) -> list[dict[str, Any]]:
+    with open(path) as file:
+        return json.load(file)
+
+
+def synthesize(
+    template: list[dict[str, Any]],
+    menus: int | None = None,
+    submenus: int | None = None,
+    dishes: int | None = None,
+) -> list[dict[str, Any]]:
+    """Menu tree shaped like the template, cycling through its entries.
+
+    A missing count keeps the number of entries the template has on that
+    level. With any count given the titles get the position of the entity
+    appended, since titles are unique across the whole table.
+    """
+    numbered = any(count is not None for count in (menus, submenus, dishes))
+
+    def title(entry: dict[str, Any], *position: int) -> str:
+        return f"{entry['title']} {'.'.join(map(str, position))}" if numbered else entry["title"]
+
+    tree = []
+    for i in range(menus or len(template)):
+        menu = template[i % len(template)]
+        menu_submenus = menu["submenus"]
+        tree.append(
+            {
+                "title": title(menu, i + 1),
+                "description": menu["description"],
+                "submenus": [
+                    {
+                        "title": title(submenu, i + 1, j + 1),
+                        "description": submenu["description"],
+                        "dishes": [
+                            {
+                                "title": title(dish, i + 1, j + 1, k + 1),
+                                "description": dish["description"],
+                                "price": Decimal(dish["price"]),
+                            }
+                            for k, dish in enumerate(cycle(submenu["dishes"], dishes))
+                        ],
+                    }
+                    for j, submenu in enumerate(cycle(menu_submenus, submenus))
+                ],
+            }
+        )
+    return tree
+
+
+def cycle(entries: list[dict[str, Any]], count: int | None) -> list[dict[str, Any]]:
+    if count is None:
+        return entries
+    if not entries:
+        return []
+    return [entries[index % len(entries)] for index in range(count)]
+
+
+def count_dishes(
+    template: list[dict[str, Any]],
+    menus: int | None = None,
+    submenus: int | None = None,
+    dishes: int | None = None,
+) -> int:
+    """Upper bound of the dishes synthesize would produce"""
+    most_submenus = max((len(menu["submenus"]) for menu in template), default=0)
+    most_dishes = max((len(submenu["dishes"]) for menu in template for submenu in menu["submenus"]), default=0)
+    return (menus or len(template)) * (submenus or most_submenus) * (dishes or most_dishes)
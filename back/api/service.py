@@ -1,8 +1,10 @@
+from decimal import Decimal
+
 from db.models import Dish, Menu, Submenu
+from db.staging import import_dish, import_menu, import_submenu
 from fastapi import HTTPException, Query, status
-from sqlalchemy import delete, distinct, func, select
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload
+from sqlalchemy import Boolean, String, cast, delete, func, insert, literal_column, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 
 class ServiceExc:
@@ -20,6 +22,13 @@ class ServiceExc:
             detail=f"{value} title already exists",
         )
 
+    @staticmethod
+    def bad_request(detail: str) -> HTTPException:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=detail,
+        )
+
 
 class ServiceQuery:
     @staticmethod
@@ -28,70 +37,34 @@ class ServiceQuery:
             case "select":
                 query = select(Menu).filter(Menu.id == menu_id)
             case "delete":
-                query = delete(Menu).filter(Menu.id == menu_id)
+                query = delete(Menu).filter(Menu.id == menu_id).returning(Menu.id)
+        return query
+
+    @staticmethod
+    def insert_menu(values: dict) -> Query:
+        query = insert(Menu).values(**values).returning(*Menu.__table__.c)
+        return query
+
+    @staticmethod
+    def update_menu(menu_id: int, values: dict) -> Query:
+        query = update(Menu).filter(Menu.id == menu_id).values(**values).returning(*Menu.__table__.c)
         return query
 
     @staticmethod
     def select_menu_list() -> Query:
         """Select all menu"""
-        query = (
-            select(
-                Menu,
-                func.count(distinct(Submenu.id)),
-                func.count(Dish.id),
-            )
-            .join(
-                Menu.submenus,
-                isouter=True,
-            )
-            .join(
-                Submenu.dishes,
-                isouter=True,
-            )
-            .group_by(
-                Menu.id,
-            )
-        )
+        query = select(Menu)
         return query
 
     @staticmethod
     def select_menu(menu_id: int) -> Query:
         """Select one menu"""
-        query = (
-            select(
-                Menu,
-                func.count(distinct(Submenu.id)),
-                func.count(Dish.id),
-            )
-            .join(
-                Menu.submenus,
-                isouter=True,
-            )
-            .join(
-                Submenu.dishes,
-                isouter=True,
-            )
-            .filter(Menu.id == menu_id)
-            .group_by(Menu.id)
-        )
+        query = select(Menu).filter(Menu.id == menu_id)
         return query
 
     @staticmethod
     def select_submenu_list(menu_id: int) -> Query:
-        query = (
-            select(
-                Submenu,
-                func.count(Dish.id),
-            )
-            .join(
-                Submenu.dishes,
-                isouter=True,
-            )
-            .filter(
-                Submenu.menu_id == menu_id,
-            )
-            .group_by(Submenu.id)
-        )
+        query = select(Submenu).filter(Submenu.menu_id == menu_id)
         return query
 
     @staticmethod
@@ -99,11 +72,6 @@ class ServiceQuery:
         query = (
             select(
                 Submenu,
-                func.count(Dish.id),
-            )
-            .join(
-                Submenu.dishes,
-                isouter=True,
             )
             .filter(
                 Submenu.menu_id == menu_id,
@@ -111,9 +79,6 @@ class ServiceQuery:
             .filter(
                 Submenu.id == submenu_id,
             )
-            .group_by(
-                Submenu.id,
-            )
         )
         return query
 
@@ -143,9 +108,61 @@ class ServiceQuery:
                     .filter(
                         Submenu.menu_id == menu_id,
                     )
+                    .returning(
+                        Submenu.id,
+                    )
                 )
         return query
 
+    @staticmethod
+    def insert_submenu(menu_id: int, values: dict) -> Query:
+        """Insert a submenu if the menu exists"""
+        query = (
+            insert(Submenu)
+            .from_select(
+                ["title", "description", "menu_id"],
+                select(
+                    cast(values["title"], String),
+                    cast(values.get("description"), String),
+                    Menu.id,
+                ).filter(
+                    Menu.id == menu_id,
+                ),
+            )
+            .returning(*Submenu.__table__.c)
+        )
+        return query
+
+    @staticmethod
+    def lock_menu(menu_id: int) -> Query:
+        """Menu id, the row kept from being deleted until the transaction ends"""
+        query = select(Menu.id).filter(Menu.id == menu_id).with_for_update(key_share=True)
+        return query
+
+    @staticmethod
+    def insert_submenus(menu_id: int, rows: list[dict]) -> Query:
+        """Insert submenus of the menu in one statement, skipping taken titles"""
+        query = (
+            pg_insert(Submenu)
+            .values([{**row, "menu_id": menu_id} for row in rows])
+            .on_conflict_do_nothing(index_elements=["title"])
+            .returning(*Submenu.__table__.c)
+        )
+        return query
+
+    @staticmethod
+    def update_submenu(menu_id: int, submenu_id: int, values: dict) -> Query:
+        query = (
+            update(Submenu)
+            .filter(
+                Submenu.id == submenu_id,
+                Submenu.menu_id == menu_id,
+            )
+            .values(**values)
+            .returning(*Submenu.__table__.c)
+        )
+        return query
+
     @staticmethod
     def select_dish_list(menu_id: int, submenu_id: int) -> Query:
         query = (
@@ -197,35 +214,212 @@ class ServiceQuery:
                     )
                 )
             case "delete":
-                query = delete(
-                    Dish,
-                ).filter(
-                    Dish.submenu_id == submenu_id,
-                    Dish.id == dish_id,
+                query = (
+                    delete(
+                        Dish,
+                    )
+                    .filter(
+                        Dish.submenu_id == submenu_id,
+                        Dish.id == dish_id,
+                        ServiceQuery.submenu_in_menu(menu_id),
+                    )
+                    .returning(
+                        Dish.id,
+                    )
                 )
         return query
 
     @staticmethod
-    async def add_test_data(
-        title: str, desc: str, table: str, db: AsyncSession, id: int | None = None, price: str | None = None
-    ) -> Query:
-        match table:
-            case "menu":
-                data = Menu(title=title, description=desc)  # type: ignore[call-arg, assignment]
-            case "submenu":
-                data = Submenu(title=title, description=desc, menu_id=id)  # type: ignore[call-arg, assignment]
-            case "dish":
-                data = Dish(
-                    title=title, description=desc, price=price, submenu_id=id
-                )  # type: ignore[call-arg, assignment]
+    def submenu_in_menu(menu_id: int):
+        """Dish condition: its submenu belongs to the menu"""
+        return (
+            select(Submenu.id)
+            .filter(
+                Submenu.id == Dish.submenu_id,
+                Submenu.menu_id == menu_id,
+            )
+            .exists()
+        )
+
+    @staticmethod
+    def insert_dish(menu_id: int, submenu_id: int, values: dict) -> Query:
+        """Insert a dish if the submenu exists in the menu"""
+        query = (
+            insert(Dish)
+            .from_select(
+                ["title", "description", "price", "submenu_id"],
+                select(
+                    cast(values["title"], String),
+                    cast(values.get("description"), String),
+                    cast(values.get("price"), Dish.price.type),
+                    Submenu.id,
+                ).filter(
+                    Submenu.id == submenu_id,
+                    Submenu.menu_id == menu_id,
+                ),
+            )
+            .returning(*Dish.__table__.c)
+        )
+        return query
+
+    @staticmethod
+    def lock_submenu(menu_id: int, submenu_id: int) -> Query:
+        """Submenu id if it belongs to the menu, the row kept from being deleted"""
+        query = (
+            select(Submenu.id)
+            .filter(
+                Submenu.id == submenu_id,
+                Submenu.menu_id == menu_id,
+            )
+            .with_for_update(key_share=True)
+        )
+        return query
 
-        db.add(data)
-        await db.commit()
-        await db.refresh(data)
-        return data
+    @staticmethod
+    def insert_dishes(submenu_id: int, rows: list[dict]) -> Query:
+        """Insert dishes of the submenu in one statement, skipping taken titles"""
+        query = (
+            pg_insert(Dish)
+            .values([{**row, "submenu_id": submenu_id} for row in rows])
+            .on_conflict_do_nothing(index_elements=["title"])
+            .returning(*Dish.__table__.c)
+        )
+        return query
 
     @staticmethod
-    def get_all_menu():
-        query = select(Menu).options(joinedload(Menu.submenus).joinedload(Submenu.dishes))
+    def update_dish(menu_id: int, submenu_id: int, dish_id: int, values: dict) -> Query:
+        query = (
+            update(Dish)
+            .filter(
+                Dish.id == dish_id,
+                Dish.submenu_id == submenu_id,
+                ServiceQuery.submenu_in_menu(menu_id),
+            )
+            .values(**values)
+            .returning(*Dish.__table__.c)
+        )
+        return query
 
+    @staticmethod
+    def reprice_dishes(menu_id: int, submenu_id: int | None, percent: Decimal | None, delta: Decimal | None) -> Query:
+        """Shift the price of every dish of the menu, or of one of its submenus, in one statement"""
+        price = Dish.price * (1 + percent / 100) if percent is not None else Dish.price + delta
+        query = (
+            update(Dish)
+            .filter(ServiceQuery.submenu_in_menu(menu_id))
+            .values(price=func.greatest(func.round(price, 2), 0))
+            .returning(Dish.submenu_id)
+        )
+        if submenu_id is not None:
+            query = query.filter(Dish.submenu_id == submenu_id)
+        return query
+
+    @staticmethod
+    def insert_many(model: type[Menu | Submenu | Dish], rows: list[dict]) -> Query:
+        """One multi-row INSERT returning the id of every row by its title"""
+        query = insert(model).values(rows).returning(model.id, model.title)
+        return query
+
+    @staticmethod
+    def count_upserted(query) -> Query:
+        """Rows the upsert inserted and updated; rows it left as they were are not returned"""
+        upserted = query.returning(literal_column("xmax = 0", Boolean).label("inserted")).cte("upserted")
+        return select(
+            func.count().filter(upserted.c.inserted).label("created"),
+            func.count().filter(~upserted.c.inserted).label("updated"),
+        )
+
+    @staticmethod
+    def upsert_imported_menus() -> Query:
+        staged = (
+            select(import_menu.c.title, import_menu.c.description)
+            .distinct(import_menu.c.title)
+            .order_by(import_menu.c.title, import_menu.c.position.desc())
+        )
+        query = pg_insert(Menu).from_select(["title", "description"], staged)
+        query = query.on_conflict_do_update(
+            index_elements=["title"],
+            set_={"description": query.excluded.description},
+            where=Menu.description.is_distinct_from(query.excluded.description),
+        )
+        return ServiceQuery.count_upserted(query)
+
+    @staticmethod
+    def upsert_imported_submenus() -> Query:
+        """Submenus under the menus of their titles; existing ones keep their menu"""
+        staged = (
+            select(import_submenu.c.title, import_submenu.c.description, Menu.id)
+            .join(Menu, Menu.title == import_submenu.c.menu_title)
+            .distinct(import_submenu.c.title)
+            .order_by(import_submenu.c.title, import_submenu.c.position.desc())
+        )
+        query = pg_insert(Submenu).from_select(["title", "description", "menu_id"], staged)
+        query = query.on_conflict_do_update(
+            index_elements=["title"],
+            set_={"description": query.excluded.description},
+            where=Submenu.description.is_distinct_from(query.excluded.description),
+        )
+        return ServiceQuery.count_upserted(query)
+
+    @staticmethod
+    def upsert_imported_dishes() -> Query:
+        """Dishes under the submenus of their titles; existing ones keep their submenu"""
+        staged = (
+            select(import_dish.c.title, import_dish.c.description, import_dish.c.price, Submenu.id)
+            .join(Submenu, Submenu.title == import_dish.c.submenu_title)
+            .distinct(import_dish.c.title)
+            .order_by(import_dish.c.title, import_dish.c.position.desc())
+        )
+        query = pg_insert(Dish).from_select(["title", "description", "price", "submenu_id"], staged)
+        query = query.on_conflict_do_update(
+            index_elements=["title"],
+            set_={"description": query.excluded.description, "price": query.excluded.price},
+            where=or_(
+                Dish.description.is_distinct_from(query.excluded.description),
+                Dish.price.is_distinct_from(query.excluded.price),
+            ),
+        )
+        return ServiceQuery.count_upserted(query)
+
+    @staticmethod
+    def select_imported_menu_ids() -> Query:
+        """Menus the staged rows belong to, whether they changed or not"""
+        submenu_titles = select(import_submenu.c.title).union(select(import_dish.c.submenu_title))
+        query = (
+            select(Menu.id)
+            .filter(Menu.title.in_(select(import_menu.c.title)))
+            .union(select(Submenu.menu_id).filter(Submenu.title.in_(submenu_titles)))
+        )
+        return query
+
+    @staticmethod
+    def select_menu_tree() -> Query:
+        """Menu, submenu and dish rows of the whole tree in tree order"""
+        query = (
+            select(
+                Menu.id.label("menu_id"),
+                Menu.title.label("menu_title"),
+                Menu.description.label("menu_description"),
+                Submenu.id.label("submenu_id"),
+                Submenu.title.label("submenu_title"),
+                Submenu.description.label("submenu_description"),
+                Dish.id.label("dish_id"),
+                Dish.title.label("dish_title"),
+                Dish.description.label("dish_description"),
+                Dish.price.label("dish_price"),
+            )
+            .outerjoin(Submenu, Submenu.menu_id == Menu.id)
+            .outerjoin(Dish, Dish.submenu_id == Submenu.id)
+            .order_by(Menu.id, Submenu.id, Dish.id)
+        )
+        return query
+
+    @staticmethod
+    def select_menu_full() -> Query:
+        """Rows of the menu tree with the counters of menus and submenus"""
+        query = ServiceQuery.select_menu_tree().add_columns(
+            Menu.submenus_count.label("submenus_count"),
+            Menu.dishes_count.label("dishes_count"),
+            Submenu.dishes_count.label("submenu_dishes_count"),
+        )
         return query
@@ -0,0 +1,94 @@
+import gzip
+import logging
+import os
+import shutil
+import time
+from collections import defaultdict
+from collections.abc import Callable
+from pathlib import Path
+
+from config import EXPORT_DIR, EXPORT_DISK_BUDGET, EXPORT_MAX_AGE
+
+logger = logging.getLogger(__name__)
+
+PARTIAL_SUFFIX = ".part"
+GZIP_SUFFIX = ".gz"
+
+
+def export_path(file_name: str) -> Path:
+    return Path(EXPORT_DIR) / file_name
+
+
+def gzip_path(path: Path) -> Path:
+    return path.with_name(path.name + GZIP_SUFFIX)
+
+
+def save_atomically(path: Path, write: Callable[[str], None], owner: str) -> None:
+    """Write the file under a temporary name so readers never see a partial export.
+
+    The name includes the owner, so duplicate tasks writing the same export
+    never share a partial file.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(f"{path.name}.{owner}{PARTIAL_SUFFIX}")
+    try:
+        write(str(partial))
+        os.replace(partial, path)
+    finally:
+        partial.unlink(missing_ok=True)
+
+
+def compress(path: Path, owner: str) -> None:
+    def write(file_name: str) -> None:
+        with open(path, "rb") as source, gzip.open(file_name, "wb", compresslevel=6) as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+
+    save_atomically(gzip_path(path), write, owner)
+
+
+def touch(path: Path) -> None:
+    """Mark the file as just downloaded, whatever the atime policy of the mount"""
+    try:
+        os.utime(path, (time.time(), path.stat().st_mtime))
+    except FileNotFoundError:
+        pass
+
+
+def enforce_retention(keep: Path | None = None) -> list[str]:
+    """Remove exports past the max age, then the least recently downloaded ones over the disk budget.
+
+    A file and its gzip copy are kept or removed together; files still
+    being written only go once they are past the max age.
+    """
+    groups: dict[str, list[tuple[Path, os.stat_result]]] = defaultdict(list)
+    for entry in os.scandir(EXPORT_DIR):
+        if entry.is_file():
+            path = Path(entry.path)
+            try:
+                groups[path.name.removesuffix(GZIP_SUFFIX)].append((path, path.stat()))
+            except FileNotFoundError:
+                continue
+
+    now = time.time()
+    removed = []
+    candidates = []
+    for name, files in groups.items():
+        created = min(stat.st_mtime for _, stat in files)
+        if now - created > EXPORT_MAX_AGE:
+            removed.append(name)
+        elif not name.endswith(PARTIAL_SUFFIX) and (keep is None or name != keep.name):
+            candidates.append((max(stat.st_atime for _, stat in files), name))
+
+    used = sum(stat.st_size for name, files in groups.items() if name not in removed for _, stat in files)
+    for _, name in sorted(candidates):
+        if used <= EXPORT_DISK_BUDGET:
+            break
+        used -= sum(stat.st_size for _, stat in groups[name])
+        removed.append(name)
+
+    for name in removed:
+        for path, _ in groups[name]:
+            path.unlink(missing_ok=True)
+    if removed:
+        logger.info("Removed exports %s", ", ".join(removed))
+    return removed
@@ -1,17 +1,165 @@
-from datetime import datetime
+import time
+from collections.abc import Callable, Iterable, Iterator
+from functools import partial
+from pathlib import Path
 from typing import Any
 
-import openpyxl
+from celery import chord
+from config import EXPORT_CHUNK_SIZE, EXPORT_GZIP, EXPORT_SHARD_ROWS, EXPORT_STALL_TIMEOUT, EXPORT_TTL
+from db.engine import get_sync_engine
+from db.models import Menu
+from db.redis import sync_redis_client
+from sqlalchemy import func, select
+from sqlalchemy.engine import Row
 
 from .celery_app import celery_app
+from .exporters import EXPORTERS, Exporter, ExportFormat
+from .service import ServiceQuery
+from .storage import PARTIAL_SUFFIX, compress, enforce_retention, export_path, save_atomically
+
+
+PROGRESS = "PROGRESS"
+
+
+@celery_app.task(bind=True)
+def export_menu(self, version: int, file_format: str):
+    beat(self.request.id, version, file_format)
+    shards, total = plan_shards()
+    if len(shards) <= 1 or EXPORTERS[ExportFormat(file_format)].merge is None:
+        report = partial(self.update_state, state=PROGRESS)
+        return write_export(self.request.id, version, file_format, report, total)
+
+    # the merge step takes over the id of this task, and with it its result
+    file_name = export_file_name(version, ExportFormat(file_format))
+    parts = [str(export_path(f"{file_name}.{self.request.id}.{index}{PARTIAL_SUFFIX}")) for index in range(len(shards))]
+    self.update_state(state=PROGRESS, meta=progress(0, total))
+    task_id = self.request.id
+    return self.replace(
+        chord(
+            (
+                export_shard.s(task_id, version, file_format, first_id, last_id, part, total)
+                for (first_id, last_id), part in zip(shards, parts)
+            ),
+            merge_export.s(task_id, version, file_format),
+        )
+    )
+
+
+@celery_app.task(bind=True)
+def export_shard(
+    self,
+    task_id: str,
+    version: int,
+    file_format: str,
+    first_id: int,
+    last_id: int,
+    part: str,
+    total: int,
+) -> str:
+    """Write the rows of a run of menus into a part of the export"""
+    shard_written = 0
+
+    def report(meta: dict[str, int]) -> None:
+        # rows written by all the shards so far, kept as the progress of the export task
+        nonlocal shard_written
+        with sync_redis_client.pipeline() as pipe:
+            pipe.incrby(rows_key(task_id), meta["rows"] - shard_written)
+            pipe.expire(rows_key(task_id), EXPORT_TTL)
+            written, _ = pipe.execute()
+        shard_written = meta["rows"]
+        beat(task_id, version, file_format)
+        self.update_state(task_id=task_id, state=PROGRESS, meta=progress(written, total))
+
+    records = report_progress(report, tree_rows(first_id, last_id), total)
+    EXPORTERS[ExportFormat(file_format)].write(records, part)
+    return part
 
 
 @celery_app.task
-def save_data_to_xlsx(data: dict):
-    file_name = f"{datetime.now().strftime('%d-%m-%Y-%H-%M')}_menu.xlsx"
-    file_path = f"task_files/{file_name}"
-    save_to_xlsx(data, file_path)
-    return {"file_name": file_name}
+def merge_export(parts: list[str], task_id: str, version: int, file_format: str) -> dict[str, str]:
+    beat(task_id, version, file_format)
+    exporter = EXPORTERS[ExportFormat(file_format)]
+    if exporter.merge is None:
+        raise ValueError(f"{file_format} exports cannot be merged")
+    file_name = export_file_name(version, ExportFormat(file_format))
+    file_path = export_path(file_name)
+    try:
+        save_atomically(file_path, partial(exporter.merge, parts), task_id)
+    finally:
+        for part in parts:
+            Path(part).unlink(missing_ok=True)
+    result = finish_export(exporter, file_path, file_format, task_id)
+    beat(task_id, version, file_format, claim_ttl=EXPORT_TTL)
+    return result
+
+
+def run_local_export(task_id: str, version: int, file_format: str, progress_by_task) -> dict[str, str]:
+    """Export in a worker process of the local backend, progress kept in a shared dict"""
+
+    def report(meta: dict[str, int]) -> None:
+        progress_by_task[task_id] = meta
+
+    beat(task_id, version, file_format)
+    return write_export(task_id, version, file_format, report, count_tree_rows())
+
+
+def write_export(
+    task_id: str,
+    version: int,
+    file_format: str,
+    report: Callable[..., Any],
+    total: int,
+) -> dict[str, str]:
+    exporter = EXPORTERS[ExportFormat(file_format)]
+    file_name = export_file_name(version, ExportFormat(file_format))
+    file_path = export_path(file_name)
+
+    def report_alive(meta: dict[str, int]) -> None:
+        beat(task_id, version, file_format)
+        report(meta=meta)
+
+    records = report_progress(report_alive, tree_rows(), total)
+    save_atomically(file_path, partial(exporter.write, records), task_id)
+    result = finish_export(exporter, file_path, file_format, task_id)
+    beat(task_id, version, file_format, claim_ttl=EXPORT_TTL)
+    return result
+
+
+def finish_export(exporter: Exporter, file_path: Path, file_format: str, task_id: str) -> dict[str, str]:
+    if EXPORT_GZIP and exporter.compressible:
+        compress(file_path, task_id)
+    enforce_retention(keep=file_path)
+    return {"file_name": file_path.name, "format": file_format}
+
+
+def export_file_name(version: int, file_format: ExportFormat) -> str:
+    """Exports of the same data version share one file per format"""
+    return f"{version}_menu.{file_format.value}"
+
+
+def export_claim(version: int, file_format: str) -> str:
+    """Key holding the id of the task exporting the data version in the format"""
+    return f"export:{file_format}:{version}"
+
+
+def rows_key(task_id: str) -> str:
+    return f"export:rows:{task_id}"
+
+
+def beat_key(task_id: str) -> str:
+    return f"export:beat:{task_id}"
+
+
+def beat(task_id: str, version: int, file_format: str, claim_ttl: int = EXPORT_STALL_TIMEOUT) -> None:
+    """Record a sign of life of the export and keep its claim on the data version.
+
+    The claim outlives a dead worker by EXPORT_STALL_TIMEOUT at most, and
+    once the file is written it is kept for as long as the file is reusable.
+    """
+    with sync_redis_client.pipeline() as pipe:
+        pipe.set(beat_key(task_id), int(time.time()), ex=EXPORT_TTL)
+        pipe.expire(export_claim(version, file_format), claim_ttl)
+        pipe.execute()
 
 
 def get_result(task_id: str):
@@ -19,36 +167,66 @@ def get_result(task_id: str):
     return task
 
 
-def save_to_xlsx(data: dict[Any, Any], file_name: str) -> None:
-    book = openpyxl.Workbook()
-    sheet = book.active
-    menu_row, menu_column, menu_counter = 1, 1, 1
-    for menu in data:
-        sheet.cell(menu_row, menu_column).value = menu_counter
-        sheet.cell(menu_row, menu_column + 1).value = menu["title"]
-        sheet.cell(menu_row, menu_column + 2).value = menu["description"]
-        menu_counter += 1
-        submenu_row = menu_row + 1
-        submenu_column = menu_column + 1
-        submenu_counter = 1
-        if menu["submenus"]:
-            for submenu in menu["submenus"]:
-                sheet.cell(submenu_row, submenu_column).value = submenu_counter
-                sheet.cell(submenu_row, submenu_column + 1).value = submenu["title"]
-                sheet.cell(submenu_row, submenu_column + 2).value = submenu["description"]
-                submenu_counter += 1
-                dish_row = submenu_row + 1
-                dish_column = submenu_column + 1
-                dish_counter = 1
-                if submenu["dishes"]:
-                    for dish in submenu["dishes"]:
-                        sheet.cell(dish_row, dish_column).value = dish_counter
-                        sheet.cell(dish_row, dish_column + 1).value = dish["title"]
-                        sheet.cell(dish_row, dish_column + 2).value = dish["description"]
-                        sheet.cell(dish_row, dish_column + 3).value = dish["price"]
-                        dish_counter += 1
-                        dish_row += 1
-                submenu_row = dish_row
-        menu_row = submenu_row
-    book.save(file_name)
-    book.close()
+def count_tree_rows() -> int:
+    query = select(func.count()).select_from(ServiceQuery.select_menu_tree().subquery())
+    with get_sync_engine().connect() as connection:
+        return connection.execute(query).scalar_one()
+
+
+def plan_shards(max_rows: int = EXPORT_SHARD_ROWS) -> tuple[list[tuple[int, int]], int]:
+    """Id ranges of the shards of the export, and the total of tree rows"""
+    tree = ServiceQuery.select_menu_tree().subquery()
+    query = select(tree.c.menu_id, func.count()).group_by(tree.c.menu_id).order_by(tree.c.menu_id)
+    with get_sync_engine().connect() as connection:
+        counts = [(menu_id, count) for menu_id, count in connection.execute(query)]
+    return group_shards(counts, max_rows), sum(count for _, count in counts)
+
+
+def group_shards(counts: list[tuple[int, int]], max_rows: int) -> list[tuple[int, int]]:
+    """Runs of consecutive menus of about max_rows tree rows each, as first and last menu id.
+
+    counts holds the rows of every menu in id order.
+    """
+    shards: list[tuple[int, int]] = []
+    rows = max_rows
+    for menu_id, count in counts:
+        if rows >= max_rows:
+            shards.append((menu_id, menu_id))
+            rows = 0
+        shards[-1] = (shards[-1][0], menu_id)
+        rows += count
+    return shards
+
+
+def report_progress(
+    report: Callable[..., Any],
+    records: Iterable[Row],
+    total: int,
+    every: int = EXPORT_CHUNK_SIZE,
+) -> Iterator[Row]:
+    """Pass the rows through, reporting the share of total written after every chunk"""
+    written = 0
+    for written, record in enumerate(records, start=1):
+        yield record
+        if written % every == 0:
+            report(meta=progress(written, total))
+    report(meta=progress(written, total))
+
+
+def progress(written: int, total: int) -> dict[str, int]:
+    return {"rows": written, "total": total, "percent": 100 * written // total if total else 100}
+
+
+def tree_rows(
+    first_id: int | None = None,
+    last_id: int | None = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> Iterator[Row]:
+    """Rows of the menu tree, or of a run of its menus, read through a server-side cursor"""
+    query = ServiceQuery.select_menu_tree()
+    if first_id is not None and last_id is not None:
+        query = query.where(Menu.id.between(first_id, last_id))
+    with get_sync_engine().connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(query)
+        for chunk in result.partitions(chunk_size):
+            yield from chunk
@@ -12,6 +12,13 @@ POSTGRES_PORT = os.environ.get("POSTGRES_PORT")
 PG_DB_TEST = os.environ.get("POSTGRES_DB_TEST")
 PG_HOST_TEST = os.environ.get("POSTGRES_HOST_TEST")
 
+DB_ECHO = os.environ.get("DB_ECHO", "false").lower() == "true"
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+
 
 REDIS_HOST = os.environ.get("REDIS_HOST")
 REDIS_PORT = os.environ.get("REDIS_PORT")
@@ -19,8 +26,59 @@ REDIS_DB = os.environ.get("REDIS_DB")
 REDIS_DB_TEST = os.environ.get("REDIS_DB_TEST")
 REDIS_HOST_TEST = os.environ.get("REDIS_HOST_TEST")
 
+CACHE_LOCAL_ENABLED = os.environ.get("CACHE_LOCAL_ENABLED", "false").lower() == "true"
+CACHE_LOCAL_MAX_ENTRIES = int(os.environ.get("CACHE_LOCAL_MAX_ENTRIES", 1024))
+CACHE_LOCAL_MAX_BYTES = int(os.environ.get("CACHE_LOCAL_MAX_BYTES", 16 * 1024 * 1024))
+
+# Seconds a cached value is served as fresh, per key family
+CACHE_TTL_MENU = int(os.environ.get("CACHE_TTL_MENU", 300))
+CACHE_TTL_SUBMENU = int(os.environ.get("CACHE_TTL_SUBMENU", 300))
+CACHE_TTL_DISH = int(os.environ.get("CACHE_TTL_DISH", 300))
+# Seconds a value is still served while it is recomputed in the background
+CACHE_STALE_TTL = int(os.environ.get("CACHE_STALE_TTL", 3600))
+# Seconds one worker may hold the recompute lock of a key
+CACHE_LOCK_TIMEOUT = int(os.environ.get("CACHE_LOCK_TIMEOUT", 10))
+# Seconds clients may reuse a read response without revalidating its ETag
+HTTP_CACHE_MAX_AGE = int(os.environ.get("HTTP_CACHE_MAX_AGE", 0))
+
+PAGE_LIMIT_DEFAULT = int(os.environ.get("PAGE_LIMIT_DEFAULT", 100))
+PAGE_LIMIT_MAX = int(os.environ.get("PAGE_LIMIT_MAX", 1000))
+
+# Rows per multi-row INSERT when seeding test data
+SEED_CHUNK_SIZE = int(os.environ.get("SEED_CHUNK_SIZE", 1000))
+# Most dishes one /generate_data request may create
+SEED_MAX_DISHES = int(os.environ.get("SEED_MAX_DISHES", 1000000))
+# Most submenus or dishes one batch create request may carry
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 1000))
+# Rows per COPY into the staging tables of a tree import
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", 5000))
+
 BROKER_URL = os.environ.get("BROKER_URL")
 RABBITMQ_USER = os.environ.get("RABBITMQ_USER")
 RABBITMQ_PASS = os.environ.get("RABBITMQ_PASS")
 RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST")
 RABBITMQ_PORT = os.environ.get("RABBITMQ_PORT")
+
+# Rows fetched per round trip of the export cursor
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 1000))
+# Seconds an export stays reusable for unchanged menu data
+EXPORT_TTL = int(os.environ.get("EXPORT_TTL", 86400))
+# Seconds without progress after which a running export counts as dead
+EXPORT_STALL_TIMEOUT = int(os.environ.get("EXPORT_STALL_TIMEOUT", 600))
+# Seconds an export may wait for a worker before it counts as lost
+EXPORT_QUEUE_TIMEOUT = int(os.environ.get("EXPORT_QUEUE_TIMEOUT", 3600))
+# Longest long-poll of the export status, seconds
+EXPORT_WAIT_MAX = int(os.environ.get("EXPORT_WAIT_MAX", 60))
+# Directory shared by the workers writing exports and the API serving them
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "/app/task_files")
+# Bytes the export files may take before the least recently downloaded go
+EXPORT_DISK_BUDGET = int(os.environ.get("EXPORT_DISK_BUDGET", 1024 * 1024 * 1024))
+# Seconds after which an export file is removed regardless of the budget
+EXPORT_MAX_AGE = int(os.environ.get("EXPORT_MAX_AGE", EXPORT_TTL))
+# Store a gzip copy of text exports next to the file
+EXPORT_GZIP = os.environ.get("EXPORT_GZIP", "true").lower() == "true"
+# Where exports run: "celery" workers or a "local" process pool of the API
+EXPORT_BACKEND = os.environ.get("EXPORT_BACKEND", "celery")
+EXPORT_LOCAL_WORKERS = int(os.environ.get("EXPORT_LOCAL_WORKERS", 2))
+# Rows above which a Celery export is split by menu into parallel shards
+EXPORT_SHARD_ROWS = int(os.environ.get("EXPORT_SHARD_ROWS", 200000))
@@ -1,16 +1,41 @@
+from collections.abc import Callable
+from contextlib import AbstractAsyncContextManager
+from functools import lru_cache
+
 from config import (
+    DB_ECHO,
+    DB_MAX_OVERFLOW,
+    DB_POOL_PRE_PING,
+    DB_POOL_RECYCLE,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
     POSTGRES_DB,
     POSTGRES_HOST,
     POSTGRES_PASSWORD,
     POSTGRES_PORT,
     POSTGRES_USER,
 )
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
+from .pool import InstrumentedPool, pool_stats
+
 DB_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+SYNC_DB_URL = f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 
-engine = create_async_engine(DB_URL, echo=True)
+engine = create_async_engine(
+    DB_URL,
+    echo=DB_ECHO,
+    poolclass=InstrumentedPool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+)
+pool_stats.watch(engine.sync_engine.pool)
 
 async_session = sessionmaker(
     bind=engine,
@@ -19,6 +44,25 @@ async_session = sessionmaker(
 )
 
 
-async def get_session():
-    async with async_session() as session:
-        yield session
+class LazySession:
+    """Hands out sessions on demand.
+
+    Nothing is checked out of the pool until a query runs, and the
+    connection goes back as soon as the `async with` block exits.
+    """
+
+    def __init__(self, factory: Callable[[], AbstractAsyncContextManager[AsyncSession]] = async_session):
+        self.factory = factory
+
+    def __call__(self) -> AbstractAsyncContextManager[AsyncSession]:
+        return self.factory()
+
+
+def get_session() -> LazySession:
+    return LazySession()
+
+
+@lru_cache
+def get_sync_engine() -> Engine:
+    """Blocking engine for Celery workers, created on first use"""
+    return create_engine(SYNC_DB_URL, echo=DB_ECHO, pool_pre_ping=DB_POOL_PRE_PING)
@@ -0,0 +1,61 @@
+"""menu and submenu counter columns
+
+Revision ID: 5f2c8e41b7a3
+Revises: cda627c66ae9
+Create Date: 2026-10-18 10:12:41.530211
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from db.triggers import COUNTER_TRIGGERS
+
+# revision identifiers, used by Alembic.
+revision = "5f2c8e41b7a3"
+down_revision = "cda627c66ae9"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("menu", sa.Column("submenus_count", sa.Integer(), server_default="0", nullable=False))
+    op.add_column("menu", sa.Column("dishes_count", sa.Integer(), server_default="0", nullable=False))
+    op.add_column("submenu", sa.Column("dishes_count", sa.Integer(), server_default="0", nullable=False))
+
+    op.execute(
+        """
+        UPDATE submenu
+        SET dishes_count = counted.dishes
+        FROM (SELECT submenu_id, count(*) AS dishes FROM dich GROUP BY submenu_id) AS counted
+        WHERE submenu.id = counted.submenu_id
+        """
+    )
+    op.execute(
+        """
+        UPDATE menu
+        SET submenus_count = counted.submenus, dishes_count = counted.dishes
+        FROM (
+            SELECT menu_id, count(*) AS submenus, sum(dishes_count) AS dishes
+            FROM submenu
+            GROUP BY menu_id
+        ) AS counted
+        WHERE menu.id = counted.menu_id
+        """
+    )
+
+    for statement in COUNTER_TRIGGERS:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    for table, name in (
+        ("dich", "dish_counters_delete"),
+        ("dich", "dish_counters_insert"),
+        ("submenu", "submenu_counters_delete"),
+        ("submenu", "submenu_counters_insert"),
+    ):
+        op.execute(f"DROP TRIGGER IF EXISTS {name} ON {table}")
+        op.execute(f"DROP FUNCTION IF EXISTS {name}()")
+
+    op.drop_column("submenu", "dishes_count")
+    op.drop_column("menu", "dishes_count")
+    op.drop_column("menu", "submenus_count")
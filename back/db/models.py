@@ -1,11 +1,15 @@
 from db.base import Base
-from sqlalchemy import Column, ForeignKey, Integer, Numeric
+from db.triggers import COUNTER_TRIGGERS
+from sqlalchemy import DDL, Column, ForeignKey, Integer, Numeric, event
 from sqlalchemy.orm import relationship
 
 
 class Menu(Base):
     __tablename__ = "menu"
 
+    submenus_count = Column(Integer, nullable=False, server_default="0")
+    dishes_count = Column(Integer, nullable=False, server_default="0")
+
     submenus = relationship("Submenu", back_populates="menu", cascade="all, delete")
 
 
@@ -13,6 +17,7 @@ class Submenu(Base):
     __tablename__ = "submenu"
 
     menu_id = Column(Integer, ForeignKey("menu.id", ondelete="CASCADE"), nullable=False)
+    dishes_count = Column(Integer, nullable=False, server_default="0")
 
     menu = relationship("Menu", back_populates="submenus")
     dishes = relationship("Dish", back_populates="submenu", cascade="all, delete")
@@ -25,3 +30,7 @@ class Dish(Base):
     submenu_id = Column(Integer, ForeignKey("submenu.id", ondelete="CASCADE"), nullable=False)
 
     submenu = relationship("Submenu", back_populates="dishes")
+
+
+for trigger in COUNTER_TRIGGERS:
+    event.listen(Base.metadata, "after_create", DDL(trigger).execute_if(dialect="postgresql"))
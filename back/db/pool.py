@@ -0,0 +1,83 @@
+import time
+from bisect import bisect_left
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# Upper bounds in seconds of the checkout wait histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class PoolStats:
+    """Checkout counters and wait time histogram of a connection pool"""
+
+    def __init__(self):
+        self.pool: AsyncAdaptedQueuePool | None = None
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.timeouts = 0
+        self.max_checked_out = 0
+        self.wait_sum = 0.0
+        self.wait_counts = [0] * (len(WAIT_BUCKETS) + 1)
+
+    def watch(self, pool: AsyncAdaptedQueuePool) -> None:
+        self.pool = pool
+        event.listen(pool, "connect", self.on_connect)
+        event.listen(pool, "checkout", self.on_checkout)
+        event.listen(pool, "checkin", self.on_checkin)
+
+    def on_connect(self, dbapi_connection, connection_record) -> None:
+        self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy) -> None:
+        self.checkouts += 1
+        self.max_checked_out = max(self.max_checked_out, self.pool.checkedout())
+
+    def on_checkin(self, dbapi_connection, connection_record) -> None:
+        self.checkins += 1
+
+    def observe_wait(self, seconds: float) -> None:
+        self.wait_sum += seconds
+        self.wait_counts[bisect_left(WAIT_BUCKETS, seconds)] += 1
+
+    def snapshot(self) -> dict:
+        buckets = {}
+        total = 0
+        for bound, count in zip((*WAIT_BUCKETS, "+Inf"), self.wait_counts):
+            total += count
+            buckets[str(bound)] = total
+        return {
+            "size": self.pool.size(),
+            "checked_out": self.pool.checkedout(),
+            "checked_in": self.pool.checkedin(),
+            "overflow": self.pool.overflow(),
+            "max_checked_out": self.max_checked_out,
+            "connects": self.connects,
+            "checkouts": self.checkouts,
+            "checkins": self.checkins,
+            "timeouts": self.timeouts,
+            "wait_seconds": {
+                "buckets": buckets,
+                "count": total,
+                "sum": self.wait_sum,
+            },
+        }
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long callers wait for a connection"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            pool_stats.timeouts += 1
+            raise
+        finally:
+            pool_stats.observe_wait(time.perf_counter() - started)
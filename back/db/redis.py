@@ -1,4 +1,7 @@
 import aioredis
+import redis
 from config import REDIS_DB, REDIS_HOST
 
 redis_client = aioredis.from_url(f"redis://{REDIS_HOST}", db=REDIS_DB)
+# for the export workers, which run outside the event loop
+sync_redis_client = redis.Redis(host=REDIS_HOST, db=REDIS_DB)
@@ -0,0 +1,41 @@
+"""Temporary tables a tree import is copied into before the upsert.
+
+They live in the importing transaction only and are dropped on commit.
+Each gets a position numbering the rows in file order, so the last
+occurrence of a repeated title is the one imported.
+"""
+
+from sqlalchemy import BigInteger, Column, Identity, MetaData, Numeric, String, Table
+
+staging = MetaData()
+
+
+def temporary_table(name: str, *columns: Column) -> Table:
+    return Table(
+        name,
+        staging,
+        Column("position", BigInteger, Identity()),
+        *columns,
+        prefixes=["TEMPORARY"],
+        postgresql_on_commit="DROP",
+    )
+
+
+import_menu = temporary_table(
+    "import_menu",
+    Column("title", String(128)),
+    Column("description", String(256)),
+)
+import_submenu = temporary_table(
+    "import_submenu",
+    Column("title", String(128)),
+    Column("description", String(256)),
+    Column("menu_title", String(128)),
+)
+import_dish = temporary_table(
+    "import_dish",
+    Column("title", String(128)),
+    Column("description", String(256)),
+    Column("price", Numeric(10, 2)),
+    Column("submenu_title", String(128)),
+)
@@ -0,0 +1,126 @@
+"""Keep menu.submenus_count, menu.dishes_count and submenu.dishes_count
+in step with inserts and deletes of submenus and dishes.
+
+The triggers are statement level, so bulk inserts update each parent row
+once. Deleting a submenu subtracts its dishes from the menu; the cascaded
+dish deletes no longer find the submenu and leave the menu alone.
+"""
+
+SUBMENU_INSERT_FUNCTION = """
+CREATE OR REPLACE FUNCTION submenu_counters_insert() RETURNS trigger AS $$
+BEGIN
+    UPDATE menu
+    SET submenus_count = menu.submenus_count + added.submenus
+    FROM (
+        SELECT menu_id, count(*) AS submenus FROM new_submenus GROUP BY menu_id
+    ) AS added
+    WHERE menu.id = added.menu_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+SUBMENU_INSERT_TRIGGER = """
+CREATE TRIGGER submenu_counters_insert
+AFTER INSERT ON submenu
+REFERENCING NEW TABLE AS new_submenus
+FOR EACH STATEMENT EXECUTE FUNCTION submenu_counters_insert();
+"""
+
+SUBMENU_DELETE_FUNCTION = """
+CREATE OR REPLACE FUNCTION submenu_counters_delete() RETURNS trigger AS $$
+BEGIN
+    UPDATE menu
+    SET submenus_count = menu.submenus_count - removed.submenus,
+        dishes_count = menu.dishes_count - removed.dishes
+    FROM (
+        SELECT menu_id, count(*) AS submenus, sum(dishes_count) AS dishes
+        FROM old_submenus
+        GROUP BY menu_id
+    ) AS removed
+    WHERE menu.id = removed.menu_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+SUBMENU_DELETE_TRIGGER = """
+CREATE TRIGGER submenu_counters_delete
+AFTER DELETE ON submenu
+REFERENCING OLD TABLE AS old_submenus
+FOR EACH STATEMENT EXECUTE FUNCTION submenu_counters_delete();
+"""
+
+DISH_INSERT_FUNCTION = """
+CREATE OR REPLACE FUNCTION dish_counters_insert() RETURNS trigger AS $$
+BEGIN
+    UPDATE submenu
+    SET dishes_count = submenu.dishes_count + added.dishes
+    FROM (
+        SELECT submenu_id, count(*) AS dishes FROM new_dishes GROUP BY submenu_id
+    ) AS added
+    WHERE submenu.id = added.submenu_id;
+
+    UPDATE menu
+    SET dishes_count = menu.dishes_count + added.dishes
+    FROM (
+        SELECT submenu.menu_id, count(*) AS dishes
+        FROM new_dishes
+        JOIN submenu ON submenu.id = new_dishes.submenu_id
+        GROUP BY submenu.menu_id
+    ) AS added
+    WHERE menu.id = added.menu_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+DISH_INSERT_TRIGGER = """
+CREATE TRIGGER dish_counters_insert
+AFTER INSERT ON dich
+REFERENCING NEW TABLE AS new_dishes
+FOR EACH STATEMENT EXECUTE FUNCTION dish_counters_insert();
+"""
+
+DISH_DELETE_FUNCTION = """
+CREATE OR REPLACE FUNCTION dish_counters_delete() RETURNS trigger AS $$
+BEGIN
+    UPDATE submenu
+    SET dishes_count = submenu.dishes_count - removed.dishes
+    FROM (
+        SELECT submenu_id, count(*) AS dishes FROM old_dishes GROUP BY submenu_id
+    ) AS removed
+    WHERE submenu.id = removed.submenu_id;
+
+    UPDATE menu
+    SET dishes_count = menu.dishes_count - removed.dishes
+    FROM (
+        SELECT submenu.menu_id, count(*) AS dishes
+        FROM old_dishes
+        JOIN submenu ON submenu.id = old_dishes.submenu_id
+        GROUP BY submenu.menu_id
+    ) AS removed
+    WHERE menu.id = removed.menu_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+DISH_DELETE_TRIGGER = """
+CREATE TRIGGER dish_counters_delete
+AFTER DELETE ON dich
+REFERENCING OLD TABLE AS old_dishes
+FOR EACH STATEMENT EXECUTE FUNCTION dish_counters_delete();
+"""
+
+# one statement per item, as asyncpg prepares every statement it runs
+COUNTER_TRIGGERS = [
+    SUBMENU_INSERT_FUNCTION,
+    SUBMENU_INSERT_TRIGGER,
+    SUBMENU_DELETE_FUNCTION,
+    SUBMENU_DELETE_TRIGGER,
+    DISH_INSERT_FUNCTION,
+    DISH_INSERT_TRIGGER,
+    DISH_DELETE_FUNCTION,
+    DISH_DELETE_TRIGGER,
+]
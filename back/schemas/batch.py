@@ -0,0 +1,45 @@
+from enum import Enum
+from typing import Any
+
+from pydantic import BaseModel, constr
+
+# An id, or "$N" for the id returned by operation N (0-based) earlier in the batch
+Ref = int | constr(regex=r"^\$\d+$")
+
+
+class BatchOp(str, Enum):
+    create = "create"
+    update = "update"
+    delete = "delete"
+
+
+class BatchEntity(str, Enum):
+    menu = "menu"
+    submenu = "submenu"
+    dish = "dish"
+
+
+class BatchOperation(BaseModel):
+    op: BatchOp
+    entity: BatchEntity
+    menu_id: Ref | None
+    submenu_id: Ref | None
+    id: Ref | None
+    data: dict[str, Any] = {}
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "op": "create",
+                "entity": "submenu",
+                "menu_id": "$0",
+                "data": {
+                    "title": "My submenu",
+                    "description": "Submenu description",
+                },
+            },
+        }
+
+
+class BatchResult(BaseModel):
+    results: list[dict[str, Any]]
@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+from decimal import Decimal
+
+from pydantic import BaseModel, condecimal, root_validator
 
 
 class DishBase(BaseModel):
@@ -22,13 +24,42 @@ class DishCreate(DishBase):
 
 
 class DishUpdate(DishBase):
-    pass
+    title: str | None
+    price: str | None
 
 
 class Dish(DishBase):
     id: str
 
 
+class DishBatch(BaseModel):
+    created: list[Dish]
+    conflicts: list[str]
+
+
+class DishReprice(BaseModel):
+    # a price cannot drop by 100% or more, nor grow past the Numeric(10, 2) column
+    percent: condecimal(gt=Decimal(-100), le=Decimal(10000)) | None
+    delta: condecimal(gt=Decimal(-(10**8)), lt=Decimal(10**8)) | None
+
+    @root_validator
+    def one_adjustment(cls, values):
+        if (values.get("percent") is None) == (values.get("delta") is None):
+            raise ValueError("exactly one of percent and delta is required")
+        return values
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "percent": "7.5",
+            },
+        }
+
+
+class DishRepriceResult(BaseModel):
+    updated: int
+
+
 class DishDelete(BaseModel):
     status: str
     message: str
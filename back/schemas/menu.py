@@ -20,7 +20,7 @@ class MenuCreate(MenuBase):
 
 
 class MenuUpdate(MenuBase):
-    pass
+    title: str | None
 
 
 class Menu(MenuBase):
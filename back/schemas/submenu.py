@@ -20,7 +20,7 @@ class SubmenuCreate(SubmenuBase):
 
 
 class SubmenuUpdate(SubmenuBase):
-    pass
+    title: str | None
 
 
 class Submenu(SubmenuBase):
@@ -38,6 +38,11 @@ class Submenu(SubmenuBase):
         }
 
 
+class SubmenuBatch(BaseModel):
+    created: list[Submenu]
+    conflicts: list[str]
+
+
 class SubmenuDelete(BaseModel):
     status: str
     message: str
@@ -1,10 +1,11 @@
 import asyncio
+from contextlib import nullcontext
 
 import pytest_asyncio
 from app import app
 from config import PG_DB_TEST, PG_HOST_TEST, POSTGRES_PASSWORD, POSTGRES_USER
 from db import Base
-from db.engine import get_session
+from db.engine import LazySession, get_session
 from httpx import AsyncClient
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy_utils import create_database, database_exists
@@ -47,7 +48,7 @@ async def db(db_engine):
 
 @pytest_asyncio.fixture(scope="function")
 async def client(db):
-    app.dependency_overrides[get_session] = lambda: db
+    app.dependency_overrides[get_session] = lambda: LazySession(lambda: nullcontext(db))
     async with AsyncClient(app=app, base_url="http://test") as c:
         yield c
 
@@ -1,4 +1,23 @@
+import json
+from collections import namedtuple
+from decimal import Decimal
+
+import openpyxl
 import pytest
+from api.exporters import EXPORTERS, TREE_FIELDS, ExportFormat
+from api.responses import byte_range, file_response
+from api.tasks import group_shards
+
+TreeRow = namedtuple("TreeRow", TREE_FIELDS)
+
+
+def tree_records(menus: int) -> list[TreeRow]:
+    """Tree rows of menus with one submenu of two dishes each"""
+    return [
+        TreeRow(i, f"menu{i}", "desc", i, f"submenu{i}", "desc", 2 * i + k, f"dish{i}.{k}", "desc", Decimal("9.99"))
+        for i in range(1, menus + 1)
+        for k in range(2)
+    ]
 
 
 class TestMenus:
@@ -27,6 +46,25 @@ class TestMenus:
         assert response.json()[0]["title"] == create_menu["title"]
         assert response.json()[0]["description"] == create_menu["description"]
 
+    @pytest.mark.asyncio
+    async def test_list_menu_pages(self, client):
+        for i in range(3):
+            await client.post(self.url, json={"title": f"menu_page{i}", "description": "desc"})
+
+        first = await client.get(self.url, params={"limit": 2})
+
+        assert first.status_code == 200
+        assert [menu["title"] for menu in first.json()] == ["menu_page0", "menu_page1"]
+
+        second = await client.get(self.url, params={"limit": 2, "cursor": first.headers["x-next-cursor"]})
+
+        assert [menu["title"] for menu in second.json()] == ["menu_page2"]
+        assert "x-next-cursor" not in second.headers
+
+        error_resp = await client.get(self.url, params={"cursor": "not a cursor"})
+
+        assert error_resp.status_code == 400
+
     @pytest.mark.asyncio
     async def test_get_menu(self, client, db, create_menu):
         menu = await client.get(self.url)
@@ -44,6 +82,44 @@ class TestMenus:
         assert error_resp.status_code == 404
         assert error_resp.json() == {"detail": "menu not found"}
 
+    @pytest.mark.asyncio
+    async def test_get_menu_not_modified(self, client, create_menu):
+        response = await client.get(f"{self.url}/{create_menu['id']}")
+        etag = response.headers["etag"]
+
+        not_modified = await client.get(f"{self.url}/{create_menu['id']}", headers={"If-None-Match": etag})
+
+        assert not_modified.status_code == 304
+        assert not_modified.headers["etag"] == etag
+        assert not_modified.content == b""
+
+    @pytest.mark.asyncio
+    async def test_menu_tree(self, client, base_url_dish):
+        await client.post(base_url_dish, json={"title": "dish1", "description": "desc1", "price": "12.50"})
+
+        response = await client.get(f"{self.url}/tree")
+
+        assert response.status_code == 200
+        submenus = response.json()[0]["submenus"]
+        assert submenus[0]["title"] == "submenu1"
+        assert submenus[0]["dishes"][0]["price"] == "12.50"
+
+        lines = (await client.get(f"{self.url}/tree", params={"format": "ndjson"})).text.splitlines()
+
+        assert [json.loads(line)["type"] for line in lines] == ["menu", "submenu", "dish"]
+
+    @pytest.mark.asyncio
+    async def test_menu_full(self, client, base_url_dish):
+        before = await client.get(f"{self.url}/full")
+        await client.post(base_url_dish, json={"title": "dish1", "description": "desc1", "price": "12.50"})
+
+        response = await client.get(f"{self.url}/full")
+
+        assert response.status_code == 200
+        assert before.json()[0]["dishes_count"] == 0
+        assert response.json()[0]["dishes_count"] == 1
+        assert response.json()[0]["submenus"][0]["dishes_count"] == 1
+
     @pytest.mark.asyncio
     async def test_update_menu(self, client, db, create_menu):
         menu = await client.get(self.url)
@@ -95,6 +171,24 @@ class TestSubmenus:
         assert response.json()["title"] == self.submenu_data["title"]
         assert response.json()["description"] == self.submenu_data["description"]
 
+    @pytest.mark.asyncio
+    async def test_create_submenu_batch(self, base_url, client):
+        submenus = [self.submenu_data, {**self.submenu_data, "title": "submenu_2"}, self.submenu_data]
+        response = await client.post(base_url.replace("/submenus", "/submenus:batch"), json=submenus)
+
+        assert response.status_code == 201
+        assert [submenu["title"] for submenu in response.json()["created"]] == ["submenu1", "submenu_2"]
+        assert response.json()["conflicts"] == ["submenu1"]
+
+        submenu_list = await client.get(base_url)
+
+        assert len(submenu_list.json()) == 2
+
+        error_resp = await client.post("/api/v1/menus/0/submenus:batch", json=[self.submenu_data])
+
+        assert error_resp.status_code == 404
+        assert error_resp.json() == {"detail": "menu not found"}
+
     @pytest.mark.asyncio
     async def test_get_submenu(self, base_url, client):
         submenu_res = await client.post(base_url, json=self.submenu_data)
@@ -175,6 +269,53 @@ class TestDishes:
         assert error_resp.status_code == 404
         assert error_resp.json() == {"detail": "dish not found"}
 
+    @pytest.mark.asyncio
+    async def test_create_dish_batch(self, base_url_dish, client):
+        dishes = [self.dish_data, {**self.dish_data, "title": "dish_2"}, self.dish_data]
+        response = await client.post(base_url_dish.replace("/dishes", "/dishes:batch"), json=dishes)
+
+        assert response.status_code == 201
+        assert [dish["title"] for dish in response.json()["created"]] == ["dish_1", "dish_2"]
+        assert response.json()["conflicts"] == ["dish_1"]
+
+        dish_list = await client.get(base_url_dish)
+
+        assert len(dish_list.json()) == 2
+
+    @pytest.mark.asyncio
+    async def test_reprice_dishes(self, base_url_dish, client):
+        await client.post(base_url_dish, json={**self.dish_data, "price": "10.00"})
+        await client.post(base_url_dish, json={**self.dish_data, "title": "dish_2", "price": "1.00"})
+        reprice_url = base_url_dish.replace("/dishes", "/dishes:reprice")
+
+        response = await client.post(reprice_url, json={"percent": "12.5"})
+
+        assert response.status_code == 200
+        assert response.json() == {"updated": 2}
+
+        response = await client.post(reprice_url.split("/submenus/")[0] + "/dishes:reprice", json={"delta": "-5"})
+
+        assert response.json() == {"updated": 2}
+        dish_list = await client.get(base_url_dish)
+        assert sorted(dish["price"] for dish in dish_list.json()) == ["0.00", "6.25"]
+
+        error_resp = await client.post(reprice_url, json={"percent": "1", "delta": "1"})
+
+        assert error_resp.status_code == 422
+
+        error_resp = await client.post(reprice_url, json={"percent": "1e9"})
+
+        assert error_resp.status_code == 422
+
+    @pytest.mark.asyncio
+    async def test_reprice_dishes_overflow(self, base_url_dish, client):
+        await client.post(base_url_dish, json={**self.dish_data, "price": "99999999.99"})
+
+        error_resp = await client.post(base_url_dish.replace("/dishes", "/dishes:reprice"), json={"percent": "100"})
+
+        assert error_resp.status_code == 400
+        assert error_resp.json() == {"detail": "the new prices do not fit the price column"}
+
     @pytest.mark.asyncio
     async def test_update_dish(self, base_url_dish, client):
         update_data = {
@@ -205,3 +346,228 @@ class TestDishes:
             "status": "true",
             "message": "The dish has been deleted",
         }
+
+    @pytest.mark.asyncio
+    async def test_delete_menu_drops_cached_children(self, base_url_dish, client):
+        dish_res = await client.post(base_url_dish, json=self.dish_data)
+        submenu_url = base_url_dish.removesuffix("/dishes")
+        dish_url = f"{base_url_dish}/{dish_res.json()['id']}"
+
+        # cache both entries before their menu goes
+        assert (await client.get(submenu_url)).status_code == 200
+        assert (await client.get(dish_url)).status_code == 200
+
+        response = await client.delete(submenu_url.split("/submenus/")[0])
+
+        assert response.status_code == 200
+        assert (await client.get(submenu_url)).status_code == 404
+        assert (await client.get(dish_url)).status_code == 404
+
+
+class TestGenerateData:
+    @pytest.mark.asyncio
+    async def test_generate_data(self, client):
+        response = await client.get("/api/v1/generate_data", params={"menus": 2, "submenus": 2, "dishes": 3})
+
+        assert response.status_code == 200
+
+        menus = (await client.get("/api/v1/menus/full")).json()
+
+        assert len(menus) == 2
+        assert [menu["dishes_count"] for menu in menus] == [6, 6]
+        assert menus[1]["submenus"][1]["dishes"][2]["title"].endswith(" 2.2.3")
+
+
+class TestImport:
+    @pytest.mark.asyncio
+    async def test_import_json(self, client, create_menu):
+        tree = [
+            {
+                "title": create_menu["title"],
+                "description": "new desc",
+                "submenus": [
+                    {
+                        "title": "imported_submenu",
+                        "description": "desc",
+                        "dishes": [{"title": "imported_dish", "description": "desc", "price": "10.50"}],
+                    }
+                ],
+            },
+            {"title": "imported_menu", "description": "desc", "submenus": []},
+        ]
+        files = {"file": ("menu.json", json.dumps(tree), "application/json")}
+
+        response = await client.post("/api/v1/import", files=files)
+
+        assert response.status_code == 200
+        assert response.json()["menus"] == {"created": 1, "updated": 1}
+        assert response.json()["dishes"] == {"created": 1, "updated": 0}
+
+        menu = await client.get(f"/api/v1/menus/{create_menu['id']}")
+
+        assert menu.json()["description"] == "new desc"
+        assert menu.json()["dishes_count"] == 1
+
+        error_resp = await client.post("/api/v1/import", files={"file": ("menu.json", "[{}]", "application/json")})
+
+        assert error_resp.status_code == 400
+
+        not_a_list = {"file": ("menu.json", json.dumps(tree[1]), "application/json")}
+        error_resp = await client.post("/api/v1/import", files=not_a_list)
+
+        assert error_resp.status_code == 400
+
+
+class TestBatch:
+    url = "/api/v1/batch"
+
+    @pytest.mark.asyncio
+    async def test_batch(self, client):
+        operations = [
+            {"op": "create", "entity": "menu", "data": {"title": "batch_menu", "description": "desc"}},
+            {"op": "create", "entity": "submenu", "menu_id": "$0", "data": {"title": "batch_submenu"}},
+            {
+                "op": "create",
+                "entity": "dish",
+                "menu_id": "$0",
+                "submenu_id": "$1",
+                "data": {"title": "batch_dish", "price": "12.50"},
+            },
+            {"op": "update", "entity": "menu", "id": "$0", "data": {"description": "new desc"}},
+        ]
+        response = await client.post(self.url, json=operations)
+
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert results[2]["price"] == "12.50"
+        assert results[3]["description"] == "new desc"
+
+        menu = await client.get(f"/api/v1/menus/{results[0]['id']}")
+
+        assert menu.json()["submenus_count"] == 1
+        assert menu.json()["dishes_count"] == 1
+
+        delete = {"op": "delete", "entity": "dish", "menu_id": 0, "submenu_id": 0, "id": 0}
+        error_resp = await client.post(self.url, json=[delete])
+
+        assert error_resp.status_code == 404
+        assert error_resp.json() == {"detail": {"operation": 0, "detail": "dish not found"}}
+
+    @pytest.mark.asyncio
+    async def test_batch_submenus(self, client):
+        operations = [
+            {"op": "create", "entity": "menu", "data": {"title": "batch_menu", "description": "desc"}},
+            {"op": "create", "entity": "submenu", "menu_id": "$0", "data": {"title": "batch_submenu"}},
+            {"op": "update", "entity": "submenu", "menu_id": "$0", "id": "$1", "data": {"description": "new desc"}},
+        ]
+        response = await client.post(self.url, json=operations)
+
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert results[2]["id"] == results[1]["id"]
+        assert results[2]["description"] == "new desc"
+
+        submenus = await client.get(f"/api/v1/menus/{results[0]['id']}/submenus")
+
+        assert [submenu["title"] for submenu in submenus.json()] == ["batch_submenu"]
+
+        operations = [
+            {"op": "update", "entity": "submenu", "menu_id": results[0]["id"], "id": results[1]["id"], "data": {}},
+            {"op": "delete", "entity": "submenu", "menu_id": results[0]["id"], "id": 0},
+        ]
+        error_resp = await client.post(self.url, json=operations)
+
+        assert error_resp.status_code == 404
+        assert error_resp.json() == {"detail": {"operation": 1, "detail": "submenu not found"}}
+
+        error_resp = await client.post(self.url, json=[{"op": "create", "entity": "submenu", "menu_id": "$0"}])
+
+        assert error_resp.status_code == 400
+        assert error_resp.json()["detail"]["operation"] == 0
+
+
+class TestDownload:
+    @pytest.mark.parametrize(
+        "range_header, bounds",
+        [
+            ("bytes=2-5", (2, 5)),
+            ("bytes=-3", (7, 9)),
+            ("bytes=4-", (4, 9)),
+            ("bytes=8-20", (8, 9)),
+            ("bytes=12-", (12, 9)),
+            ("bytes=0-1,4-5", None),
+            ("items=0-1", None),
+        ],
+    )
+    def test_byte_range(self, range_header, bounds):
+        assert byte_range(range_header, 10) == bounds
+
+    @pytest.mark.asyncio
+    async def test_file_response_range(self, tmp_path):
+        path = tmp_path / "1_menu.csv"
+        path.write_bytes(b"0123456789")
+
+        response = file_response(path, "text/csv", range_header="bytes=2-5")
+
+        assert response.status_code == 206
+        assert response.headers["content-range"] == "bytes 2-5/10"
+        assert b"".join([chunk async for chunk in response.body_iterator]) == b"2345"
+
+        stale = file_response(path, "text/csv", range_header="bytes=2-5", if_range='"stale"')
+
+        assert stale.status_code == 200
+        assert stale.headers["content-length"] == "10"
+
+        error_resp = file_response(path, "text/csv", range_header="bytes=12-")
+
+        assert error_resp.status_code == 416
+        assert error_resp.headers["content-range"] == "bytes */10"
+
+
+class TestExport:
+    def test_group_shards(self):
+        assert group_shards([(1, 3), (2, 3), (5, 1), (7, 4)], 5) == [(1, 2), (5, 7)]
+        assert group_shards([(1, 30)], 5) == [(1, 1)]
+        assert group_shards([], 5) == []
+
+    @pytest.mark.parametrize("file_format", [ExportFormat.csv, ExportFormat.ndjson, ExportFormat.parquet])
+    def test_merge_matches_unsharded(self, tmp_path, file_format):
+        exporter = EXPORTERS[file_format]
+        records = tree_records(3)
+        exporter.write(records, str(tmp_path / "whole"))
+
+        parts = []
+        for first_id, last_id in group_shards([(1, 2), (2, 2), (3, 2)], 3):
+            part = str(tmp_path / f"part{first_id}")
+            exporter.write([record for record in records if first_id <= record.menu_id <= last_id], part)
+            parts.append(part)
+        exporter.merge(parts, str(tmp_path / "merged"))
+
+        assert len(parts) == 2
+        if file_format == ExportFormat.parquet:
+            import pyarrow.parquet as pq
+
+            assert pq.read_table(tmp_path / "merged").equals(pq.read_table(tmp_path / "whole"))
+        else:
+            assert (tmp_path / "merged").read_bytes() == (tmp_path / "whole").read_bytes()
+
+    def test_xlsx_layout(self, tmp_path):
+        path = tmp_path / "menu.xlsx"
+        EXPORTERS[ExportFormat.xlsx].write(tree_records(2), str(path))
+
+        book = openpyxl.load_workbook(path)
+        rows = [list(row) for row in book.active.iter_rows(values_only=True)]
+
+        assert rows == [
+            [1, "menu1", "desc", None, None, None],
+            [None, 1, "submenu1", "desc", None, None],
+            [None, None, 1, "dish1.0", "desc", 9.99],
+            [None, None, 2, "dish1.1", "desc", 9.99],
+            [2, "menu2", "desc", None, None, None],
+            [None, 1, "submenu2", "desc", None, None],
+            [None, None, 1, "dish2.0", "desc", 9.99],
+            [None, None, 2, "dish2.1", "desc", 9.99],
+        ]
+
+    def test_xlsx_has_no_merger(self):
+        assert EXPORTERS[ExportFormat.xlsx].merge is None